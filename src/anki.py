@@ -11,11 +11,22 @@
 
 
 #from __future__ import unicode_literals, print_function
-import os, sys, re, subprocess
+import os, sys, re, time
+from itertools import imap
+
+START = time.time()
+
+# answer from the warm server.py if it's running, skips
+# the imports and set-up below entirely
+if __name__ == '__main__':
+    from server import forward
+    if forward(sys.argv[1:]):
+        sys.exit(0)
+
 from lib.workflow import (Workflow, ICON_NOTE, ICON_WARNING,
                       ICON_INFO, ICON_SETTINGS, ICON_ERROR, ICON_SYNC,
-                      MATCH_ALL, MATCH_ALLCHARS)
-from lib.workflow.background import run_in_background, is_running
+                      MATCH_ALL, MATCH_ALLCHARS, MatchKey)
+import lib.acache  # registers the 'columns' cache serializer
 
 
 __usage__ = """
@@ -25,6 +36,7 @@ Usage:
     anki.py set <query>
     anki.py apath <query>
     anki.py list <query>
+    anki.py search <query>
 
 Arguments:
     <query>     Search query
@@ -37,9 +49,52 @@ Options:
 log = None
 DELIMITER = '‣'
 ICON = 'icon.png'
+MAX_RESULTS = 50
+MAX_ITEMS = 60      # results plus New Card and the status items
+REFINE_TTL = 30
+USE_GAP = 300
+MATCHERS = None     # server.py keeps a BatchMatcher per deck here
 UPDATE_SETTINGS = {'github_slug': 'DrLulz/alfred-anki'}
 
 
+# --------------------------------------------
+# Startup timings, written to the workflow log
+# at the end of every run
+
+class Startup(object):
+
+    def __init__(self, start=None):
+        self.last = start or time.time()
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        total = sum(t for _, t in self.phases)
+        timings = '  '.join('{}={:.1f}ms'.format(p, t * 1000) for p, t in self.phases)
+        log.debug('startup {}  total={:.1f}ms'.format(timings, total * 1000))
+
+startup = Startup(START)
+startup.mark('imports')
+
+
+# --------------------------------------------
+# Background helpers, only imported when a
+# refresh is due or running
+
+def run_in_background(name, args):
+    from lib.workflow.background import run_in_background
+    return run_in_background(name, args)
+
+
+def is_running(name):
+    from lib.workflow.background import is_running
+    return is_running(name)
+
+
 def get_col():
     #Try to locate Anki's collection path automatically
     import glob
@@ -69,6 +124,61 @@ class Anki_WF(object):
         self.wf = wf
         self.query = None
         self.apath = self.wf.settings.get('anki_path', None)
+        self.state = None
+        
+        
+    def deck_id(self, name):
+        '''Id of deck `name` from the decks cache, or from
+           the collection if the cache doesn't have it yet'''
+        from lib.adecks import DeckStore
+        did = DeckStore(self.wf.cachefile('decks.db')).deck_id(name)
+        if did is not None:
+            return str(did)
+
+        from lib.atools import Tools
+        at = Tools(self.apath)
+        return str(at.deck_info(name=name)['id'])
+
+
+    def count_use(self, did):
+        '''Counts entering deck `did` in deck_usage, background.py
+           prefetches the most used decks' cards first. Typing on
+           in the deck, or coming back within USE_GAP, isn't a new use.'''
+        if self.wf.cached_data('did', None, max_age=USE_GAP) == did:
+            return
+        usage = self.wf.stored_data('deck_usage') or {}
+        usage[did] = usage.get(did, 0) + 1
+        self.wf.store_data('deck_usage', usage)
+
+
+    def col_changed(self, name):
+        '''Has the collection changed since cache `name` was built?
+           background.py stores the col_state it built from as
+           <name>.colstate, the current state is read once per run.'''
+        from lib.atools import col_state
+        
+        if self.state is None:
+            self.state = col_state(self.apath)
+            if self.state is None:
+                return False
+        
+        built = self.wf.cached_data('{}.colstate'.format(name), None, max_age=0)
+        return built != self.state
+
+
+    def col_touched(self, name):
+        '''Have the collection files changed since cache `name`
+           was built? Only stats them, for paths that must not
+           open the collection; background.py stores the
+           col_stat it built from as <name>.colstat.'''
+        from lib.atools import col_stat
+
+        stat = col_stat(self.apath)
+        if stat is None:
+            return False
+
+        built = self.wf.cached_data('{}.colstat'.format(name), None, max_age=0)
+        return built != stat
         
         
     def run(self, args):
@@ -95,20 +205,18 @@ class Anki_WF(object):
 
 
         # --------------------------------------------
-        # Updates
+        # Start the query server if it's turned on
+
+        if self.wf.settings.get('server') and not is_running('server'):
+            cmd = ['/usr/bin/python', wf.workflowfile('server.py')]
+            run_in_background('server', cmd)
+
 
-        if wf.update_available:
-            wf.add_item('A newer version is available',
-                        '↩ to install update',
-                        autocomplete='workflow:update',
-                        icon='icons/update-available.png')
-                        
-                        
         self.query = args['<query>']
 #        log.debug('------------> QUERY:{!r}'.format(self.query))
 
 
-        actions = ('set', 'apath', 'list')
+        actions = ('set', 'apath', 'list', 'search')
 
         for action in actions:
             if args.get(action):
@@ -122,6 +230,18 @@ class Anki_WF(object):
         raise ValueError('Unknown action : {}'.format(action))
 
 
+    # --------------------------------------------
+    # Updates, only offered on the deck list and
+    # settings, not on every card keystroke
+
+    def show_update(self):
+        if wf.update_available:
+            wf.add_item('A newer version is available',
+                        '↩ to install update',
+                        autocomplete='workflow:update',
+                        icon='icons/update-available.png')
+
+
     # ------------------------------------------------------------------
     # ------------------------------------------------------------------
     # Show all decks in Anki collection
@@ -150,10 +270,12 @@ class Anki_WF(object):
         
         if not delim1:
             
-            decks = wf.cached_data('decks', None, max_age=0)
+            self.show_update()
+            from lib.adecks import DeckStore
+            decks = DeckStore(wf.cachefile('decks.db')).decks()
             
             
-            if not wf.cached_data_fresh('decks', max_age=43200):
+            if decks is None or self.col_changed('decks'):
                 cmd = ['/usr/bin/python', wf.workflowfile('background.py'), 'decks']
 #                log.debug('UPDATE DECKS CMD: {!r}'.format(cmd))
                 run_in_background('decks', cmd)
@@ -165,10 +287,11 @@ class Anki_WF(object):
 
 
             def key_for_deck(deck):
-                return '{} {}'.format(deck['title'], deck['id'])
+                return u'{} {}'.format(deck['name'], deck['id'])
                 
             if self.query and decks:
-                decks = wf.filter(dq, decks, key_for_deck, match_on=MATCH_ALL ^ MATCH_ALLCHARS)
+                decks = wf.filter(dq, decks, key_for_deck, match_on=MATCH_ALL ^ MATCH_ALLCHARS,
+                                  max_results=MAX_RESULTS)
         
             
             # --------------------------------------------
@@ -192,15 +315,15 @@ class Anki_WF(object):
             # --------------------------------------------
             # Loop through decks and send to Alfred
             
-            for deck in decks:
-                self.wf.add_item(
-                    title        = deck['title'],
-                    subtitle     = 'Cards:{}   New:{}   Review:{}'.format(deck['cards'], deck['new'], deck['review']),
-                    autocomplete = wf.decode('{} ‣'.format(deck['title'])),
-                    uid          = wf.decode(deck['id']),
-                    icon         = ICON)
+            self.wf.add_items(dict(
+                    title        = deck['name'],
+                    subtitle     = 'Cards:{}   New:{}   Review:{}'.format(deck['cards'], deck['new'], deck['lrn'] + deck['rev']),
+                    autocomplete = u'{} ‣'.format(deck['name']),
+                    uid          = str(deck['id']),
+                    icon         = ICON) for deck in decks)
 
             self.wf.send_feedback()
+            return 0
 
 
         # ------------------------------------------------------------------
@@ -208,26 +331,29 @@ class Anki_WF(object):
         # Deck selected, Searching cards
         
         if delim1 and not delim2:
-            def did_wrapper():
-                from lib.atools import Tools
-                at = Tools(self.apath)
-                did = at.deck_info(name=dq.strip())
-                return did['id']
-            
-            did = wf.cached_data('did', did_wrapper, max_age=1)
+            # the deck in this query, never what the last run cached
+            did = self.deck_id(dq.strip())
             log.debug('------------> SELECTED DID:{!r}'.format(did))
-            did = str(did)
+            self.count_use(did)
+            # proxy.py's new card goes to the selected deck
+            wf.cache_data('did', did)
 
 
-            cards = wf.cached_data(did, None, max_age=0)
+            # mapped, cards are only decoded as they're read
+            cache = wf.cachefile('{}.columns'.format(did))
+            stamp = os.stat(cache).st_mtime if os.path.exists(cache) else None
+            cards = wf.cached_view(did, serializer='columns')
+            thumbs = wf.cached_data('{}.thumbs'.format(did), None, max_age=0) or {}
     
-            if not wf.cached_data_fresh(did, max_age=43200):
-                     cmd = ['/usr/bin/python', wf.workflowfile('background.py'), 'cards']
-#                     log.debug('UPDATE CARDS CMD: {!r}'.format(cmd))
-                     run_in_background('cards', cmd)
+            from lib.arefresh import refresh_cards, refreshing, resume_thumbs
+            resume_thumbs(wf, did)
+            # an empty deck caches no columns at all, match included
+            stale = cards is None or (len(cards) and 'match' not in cards.names)
+            if stale or self.col_changed(did):
+                     refresh_cards(wf, did)
         
         
-            if is_running('cards'):
+            if refreshing(wf, did):
                 self.wf.add_item('Updating cards... wait one...', valid=False, icon=ICON_SYNC)         
 
             
@@ -242,16 +368,61 @@ class Anki_WF(object):
                     valid    = False,
                     icon     = ICON)
 
-    
-            def key_for_card(card):
-                tags = ' '.join(list('#' + t for t in card['tags'].split()))
-#                log.debug('------------> CARD KEY FLDS:{!r}'.format(card['flds']))
-#                log.debug('------------> CARD KEY TAGS:{!r}'.format(tags))
-                return '{} {}'.format(card['flds'], tags)
 
+            # --------------------------------------------
+            # Narrow to the index candidates, score only those
+            # on their fields and tags, then read the matches
 
             if cq and cards:
-                cards = wf.filter(cq, cards, key_for_card, match_on=MATCH_ALL ^ MATCH_ALLCHARS)
+                from lib.aindex import CardIndex, search_key
+
+                from array import array
+
+                # typing on: a query that extends the last one can only
+                # match cards the last one matched
+                query = u' '.join(cq.split()).lower()
+                last_name = '{}.lastquery'.format(did)
+                last = wf.cached_data(last_name, None, max_age=REFINE_TTL)
+
+                rows = None
+                if last and last['stamp'] == stamp and query.startswith(last['query']):
+                    rows = array('I', last['rows'])
+                # the index rows only fit the cache it was stamped with
+                elif stamp == os.stat(cache).st_mtime:
+                    index = CardIndex(wf.cachefile('{}.index'.format(did)))
+                    rows = index.candidates(cq, stamp)
+#                log.debug('------------> INDEX CANDIDATES:{!r}'.format(rows))
+                if rows is None:
+                    rows = range(len(cards))
+
+                matched = []
+                # the warm server keeps the deck's keys for bulk scoring
+                if MATCHERS is not None and 'match' in cards.names:
+                    from lib.amatch import BatchMatcher
+                    matcher = MATCHERS.get(did)
+                    if matcher is None or matcher.stamp != stamp:
+                        keys = map(MatchKey.unpack, map(search_key, cards.column('flds'),
+                                   cards.column('tags')), cards.column('match'))
+                        matcher = MATCHERS[did] = BatchMatcher(keys)
+                        matcher.stamp = stamp
+                    rows = matcher.filter(wf, cq, rows, match_on=MATCH_ALL ^ MATCH_ALLCHARS,
+                                          max_results=MAX_RESULTS, matched=matched)
+                else:
+                    keys = map(search_key, cards.pick('flds', rows), cards.pick('tags', rows))
+                    # with the match keys background.py prepared, if it has yet
+                    if 'match' in cards.names:
+                        keys = map(MatchKey.unpack, keys, cards.pick('match', rows))
+                    keys = dict(zip(rows, keys))
+                    rows = wf.filter(cq, rows, keys.get, match_on=MATCH_ALL ^ MATCH_ALLCHARS,
+                                     max_results=MAX_RESULTS, matched=matched)
+                cards = [cards[i] for i in rows]
+
+                wf.cache_data(last_name, {'query': query, 'stamp': stamp,
+                                          'rows': array('I', matched).tostring()})
+
+            elif cards:
+                # read as send_feedback writes them, up to max_items
+                cards = imap(cards.__getitem__, xrange(len(cards)))
         
             
             # --------------------------------------------
@@ -276,20 +447,25 @@ class Anki_WF(object):
                 return 0
 
             
-            for card in cards:
+            def card_item(card):
                 
-                if card['img'] is None:
-                    card['img'] = ICON
+                # placeholder until the thumbs job has made it, or
+                # once another deck's thumbs evicted it
+                icon = thumbs.get(card['img'])
+                if not icon or not os.path.exists(icon):
+                    icon = ICON
 
                 tags = ' '.join(list('#' + t for t in card['tags'].split()))
         
-                self.wf.add_item(
+                return dict(
                     title    = (card['flds']).encode('utf-8'),
                     subtitle = tags,
                     autocomplete=wf.decode('{} ‣{} ‣'.format(dq, str(card['nid']))),
-                    icon     = card['img'])
+                    icon     = icon)
 
+            self.wf.add_items(card_item(card) for card in cards)
             self.wf.send_feedback()
+            return 0
         
         
         # --------------------------------------------
@@ -316,12 +492,67 @@ class Anki_WF(object):
         return 0
       
         
+    # ------------------------------------------------------------------
+    # ------------------------------------------------------------------
+    # Search notes across all decks
+    # reads only the sidecar index built by background.py search
+
+    def do_search(self):
+        from lib.asearch import SearchIndex, supported
+        
+        path = wf.cachefile('search.db')
+        
+        if not os.path.exists(path) and not supported():
+            self.wf.add_item(
+                title    = 'Search needs SQLite with FTS5',
+                subtitle = '',
+                valid    = False,
+                icon     = ICON_ERROR)
+            self.wf.send_feedback()
+            return 0
+        
+        
+        # never opens collection.anki2 on the keystroke path
+        if not os.path.exists(path) or self.col_touched('search'):
+            cmd = ['/usr/bin/python', wf.workflowfile('background.py'), 'search']
+            run_in_background('search', cmd)
+        
+        if is_running('search'):
+            self.wf.add_item('Updating search index... wait one...', valid=False, icon=ICON_SYNC)
+        
+        
+        notes = SearchIndex(path).search(self.query)
+        
+        if not notes and self.query.strip() and not is_running('search'):
+            self.wf.add_item(
+                title    = "Cant find '{}'".format(self.query),
+                subtitle = "",
+                valid    = False,
+                icon     = ICON_WARNING)
+        
+        
+        for note in notes:
+            tags = ' '.join(list('#' + t for t in note['tags'].split()))
+            deck = note['deck'] or ''
+            
+            self.wf.add_item(
+                title    = note['flds'],
+                subtitle = u'{}   {}'.format(deck, tags),
+                arg      = u'open "{0} {1}{2} {1}"'.format(deck, wf.decode(DELIMITER), note['nid']),
+                valid    = bool(deck),
+                icon     = ICON)
+        
+        self.wf.send_feedback()
+        return 0
+
+
     # ------------------------------------------------------------------
     # ------------------------------------------------------------------
     # Settings
 
     def do_set(self):
         
+        self.show_update()
         apath = {'title': 'Set anki collection path',
                  'subtitle': 'Example: /Users/.../Documents/Anki/.../collection.anki2',
                  'arg': 'trigger apath',
@@ -337,7 +568,23 @@ class Anki_WF(object):
                  'icon': ICON_SETTINGS}
                  
 
-        settings = [apath, update]
+        if self.wf.settings.get('server'):
+            server = {'title': 'Turn off query server',
+                     'subtitle': 'Run every search in a fresh process',
+                     'arg': 'server off',
+                     'uid': u'3f1f5b0c8a9e4d02b7c6e1a4d9f08b',
+                     'valid': True,
+                     'icon': ICON_SETTINGS}
+        else:
+            server = {'title': 'Turn on query server',
+                     'subtitle': 'Keep a background process warm for faster searches',
+                     'arg': 'server on',
+                     'uid': u'3f1f5b0c8a9e4d02b7c6e1a4d9f08b',
+                     'valid': True,
+                     'icon': ICON_SETTINGS}
+                 
+
+        settings = [apath, update, server]
         
         for setting in settings:
             self.wf.add_item(
@@ -411,14 +658,21 @@ class Anki_WF(object):
     
 
 def main(wf):
+    startup.mark('workflow')
+    wf.max_items = MAX_ITEMS
     from docopt import docopt
     args = docopt(__usage__, argv=wf.args)
+    startup.mark('args')
     
     log.debug('wf.args : {!r}'.format(wf.args))
     log.debug('args : {!r}'.format(args))
     
     awf = Anki_WF(wf)
-    return awf.run(args)
+    try:
+        return awf.run(args)
+    finally:
+        startup.mark('action')
+        startup.report()
 
 
 if __name__ == '__main__':
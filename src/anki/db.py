@@ -4,6 +4,8 @@
 
 import os
 import time
+import heapq
+import atexit
 
 try:
     from pysqlite2 import dbapi2 as sqlite
@@ -12,6 +14,149 @@ except ImportError:
 
 Error = sqlite.Error
 
+# Statement stats
+##########################################################################
+
+class DBStats(object):
+    "Calls, time and rows per statement, and the slowest calls."
+
+    def __init__(self, slow=0.1, keep=50):
+        self.slow = slow
+        self.keep = keep
+        self.reset()
+
+    def reset(self):
+        # sql -> [calls, total secs, max secs, rows]
+        self.queries = {}
+        # (secs, sql, args) heap of the slowest calls over self.slow
+        self.slowest = []
+
+    def add(self, sql, secs, rows=0, args=None):
+        q = self.queries.get(sql)
+        if q is None:
+            q = self.queries[sql] = [0, 0.0, 0.0, 0]
+        q[0] += 1
+        q[1] += secs
+        if secs > q[2]:
+            q[2] = secs
+        q[3] += rows
+        if secs >= self.slow:
+            heapq.heappush(self.slowest, (secs, sql, repr(args)))
+            if len(self.slowest) > self.keep:
+                heapq.heappop(self.slowest)
+
+    def report(self):
+        "Stats per statement, most total time first."
+        return [dict(sql=sql, calls=q[0], total=q[1], max=q[2], rows=q[3])
+                for sql, q in sorted(self.queries.items(),
+                                     key=lambda i: -i[1][1])]
+
+    def slowCalls(self):
+        return [dict(secs=secs, sql=sql, args=args)
+                for secs, sql, args in sorted(self.slowest, reverse=True)]
+
+    def dump(self, path):
+        from anki.utils import json
+        with open(path.replace("{pid}", str(os.getpid())), "w") as f:
+            json.dump(dict(queries=self.report(), slow=self.slowCalls()),
+                      f, indent=1)
+
+# DBSTATS=path collects stats for every DB in the process and writes
+# them to path on exit ({pid} in path is replaced by the process id).
+# DBSLOW sets the slow call threshold in ms.
+stats = None
+if os.environ.get("DBSTATS"):
+    stats = DBStats(float(os.environ.get("DBSLOW", 100)) / 1000)
+    atexit.register(stats.dump, os.environ["DBSTATS"])
+
+class Cursor(object):
+    """Cursor that adds its statement's call to the stats once its rows
+    are read, counting them and the time spent reading them."""
+
+    def __init__(self, cur, stats, sql, secs, args):
+        self._cur = cur
+        self._stats = stats
+        self._sql = sql
+        self._secs = secs
+        self._rows = 0
+        self._args = args
+
+    def _done(self):
+        if self._stats is not None:
+            self._stats.add(self._sql, self._secs, self._rows, self._args)
+            self._stats = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        t = time.time()
+        try:
+            row = self._cur.next()
+        except StopIteration:
+            self._secs += time.time() - t
+            self._done()
+            raise
+        self._secs += time.time() - t
+        self._rows += 1
+        return row
+
+    def fetchone(self):
+        t = time.time()
+        row = self._cur.fetchone()
+        self._secs += time.time() - t
+        if row is None:
+            self._done()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, *a):
+        t = time.time()
+        rows = self._cur.fetchmany(*a)
+        self._secs += time.time() - t
+        self._rows += len(rows)
+        if not rows:
+            self._done()
+        return rows
+
+    def fetchall(self):
+        t = time.time()
+        rows = self._cur.fetchall()
+        self._secs += time.time() - t
+        self._rows += len(rows)
+        self._done()
+        return rows
+
+    def close(self):
+        self._cur.close()
+        self._done()
+
+    # callers that stop reading early, or never read, are
+    # recorded when they drop the cursor
+    def __del__(self):
+        self._done()
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+# statement -> sets DB.mod, worked out once per distinct statement
+_writes = {}
+
+def isWrite(sql):
+    try:
+        return _writes[sql]
+    except KeyError:
+        # statements built with ids2str() never repeat, don't hoard them
+        if len(_writes) > 1000:
+            _writes.clear()
+        w = _writes[sql] = sql.lstrip()[:6].lower() in (
+            "insert", "update", "delete")
+        return w
+
+# DB
+##########################################################################
+
 class DB(object):
     def __init__(self, path, text=None, timeout=0):
         encpath = path
@@ -22,32 +167,49 @@ class DB(object):
             self._db.text_factory = text
         self._path = path
         self.echo = os.environ.get("DBECHO")
+        self.stats = stats
         self.mod = False
 
-    def execute(self, sql, *a, **ka):
-        s = sql.strip().lower()
+    def _execute(self, sql, a, ka):
         # mark modified?
-        for stmt in "insert", "update", "delete":
-            if s.startswith(stmt):
-                self.mod = True
-        t = time.time()
+        if isWrite(sql):
+            self.mod = True
         if ka:
             # execute("...where id = :id", id=5)
-            res = self._db.execute(sql, ka)
-        else:
-            # execute("...where id = ?", 5)
-            res = self._db.execute(sql, a)
+            return self._db.execute(sql, ka)
+        # execute("...where id = ?", 5)
+        return self._db.execute(sql, a)
+
+    def _record(self, sql, t, rows, a, ka):
+        secs = time.time() - t
+        if self.stats:
+            self.stats.add(sql, secs, rows, ka or a)
+        self._echo(sql, secs, a, ka)
+
+    def _echo(self, sql, secs, a, ka):
         if self.echo:
             #print a, ka
-            print sql, "%0.3fms" % ((time.time() - t)*1000)
+            print sql, "%0.3fms" % (secs*1000)
             if self.echo == "2":
                 print a, ka
-        return res
+
+    def execute(self, sql, *a, **ka):
+        t = time.time()
+        res = self._execute(sql, a, ka)
+        if not self.stats:
+            self._echo(sql, time.time() - t, a, ka)
+            return res
+        # rows are counted and timed as the caller reads them
+        secs = time.time() - t
+        self._echo(sql, secs, a, ka)
+        return Cursor(res, self.stats, sql, secs, ka or a)
 
     def executemany(self, sql, l):
         self.mod = True
         t = time.time()
         self._db.executemany(sql, l)
+        if self.stats:
+            self.stats.add(sql, time.time() - t)
         if self.echo:
             print sql, "%0.3fms" % ((time.time() - t)*1000)
             if self.echo == "2":
@@ -68,23 +230,35 @@ class DB(object):
     def rollback(self):
         self._db.rollback()
 
-    def scalar(self, *a, **kw):
-        res = self.execute(*a, **kw).fetchone()
+    # the helpers time the fetch along with the statement
+
+    def scalar(self, sql, *a, **kw):
+        t = time.time()
+        res = self._execute(sql, a, kw).fetchone()
+        self._record(sql, t, 1 if res else 0, a, kw)
         if res:
             return res[0]
         return None
 
-    def all(self, *a, **kw):
-        return self.execute(*a, **kw).fetchall()
+    def all(self, sql, *a, **kw):
+        t = time.time()
+        res = self._execute(sql, a, kw).fetchall()
+        self._record(sql, t, len(res), a, kw)
+        return res
 
-    def first(self, *a, **kw):
-        c = self.execute(*a, **kw)
+    def first(self, sql, *a, **kw):
+        t = time.time()
+        c = self._execute(sql, a, kw)
         res = c.fetchone()
         c.close()
+        self._record(sql, t, 1 if res else 0, a, kw)
         return res
 
-    def list(self, *a, **kw):
-        return [x[0] for x in self.execute(*a, **kw)]
+    def list(self, sql, *a, **kw):
+        t = time.time()
+        res = [x[0] for x in self._execute(sql, a, kw)]
+        self._record(sql, t, len(res), a, kw)
+        return res
 
     def close(self):
         self._db.close()
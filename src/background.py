@@ -3,17 +3,21 @@
 
 import os
 from lib.workflow import Workflow
-from lib.atools import Tools
+from lib.atools import Tools, col_state, col_stat
+import lib.acache  # registers the 'columns' cache serializer
 
 __usage__ = """
 background.py <action>
 
 Usage:
     background.py decks
-    background.py cards
+    background.py cards <did>
+    background.py search
+    background.py thumbs
 
 Arguments:
     <name>     Deck name
+    <did>      Deck id
 
 Options:
     -h, --help      Show this help text
@@ -22,64 +26,39 @@ Options:
 
 
 # --------------------------------------------
-# Process decks for Alfred
+# Create thumbnails for Alfred results
+# cards keep their media path in 'img', anki.py
+# looks the thumb up in the deck's .thumbs map
 
-def db_decks(at):
-
-    results =[]
-    decks = at.all_decks()
-
-    for d in decks:
-        deck = {'id': None, 'title': None, 'cards': None, 'new': None, 'review': None}
-
-        deck['id']    = str(d['id'])
-        deck['title'] = d['name']
-        deck['cards'] = str(at.cnt_cards(d['id'], d['name']))
-
-        stats = at.deck_stats(deck['id'], deck['title'])
-        n, r, l = stats['new'], stats['review'], stats['learning']
-        deck['new'] = n
-        deck['review'] = r+l
-
-        results.append(deck)
+def db_thumbs(paths):
+    from lib.athumbs import ThumbStore
     
-    return results
-
-
-# --------------------------------------------
-# Create thumbnail for Alfred results
-
-def create_thumb(img, Image):
-    cachedir = wf.cachedir
-    size = (250, 250)
-    name = img.split('/')[-1]
-    
-    thumb = '{}/thumbs/thumb-{}'.format(cachedir, name)
-    log.debug('\n\nTHUMB PATH: {}'.format(thumb))
+    store = ThumbStore(wf.cachefile('thumbs'), wf.cached_data('thumbs.store', None, max_age=0))
+    thumbs = store.make(paths)
     
-    if os.path.exists(thumb):
-        return thumb
-        
-    mediadir = '/'.join(thumb.split('/')[:-1])
-    if not os.path.exists(mediadir):
-        os.makedirs(mediadir)
+    # keep the thumbs dir bounded, now and then drop
+    # thumbs of media the collection doesn't use anymore
+    evicted = store.evict()
+    if store.collect_due():
+        log.debug('{} unused thumbs deleted'.format(store.collect(at.media_refs())))
+    wf.cache_data('thumbs.store', store.state())
     
-    im = Image.open(img)
-    im.thumbnail(size)
-    im.save(thumb)
-    return thumb
+    thumbs = dict((src, t) for src, t in thumbs.items() if t in store.thumbs)
+    log.debug('{} thumbs for {} images, {} evicted'.format(len(thumbs), len(paths), evicted))
+    return thumbs
     
 
 # --------------------------------------------
 # Process cards for Alfred
 
-def db_cards(at, did):
+def db_cards(at, did, since=None):
+    from lib.aindex import card_key
     
     results = []
-    notes = at.deck_notes(did)
+    notes = at.deck_notes(did, since)
     
     for n in notes:
-        note = {'nid': None, 'flds': None, 'tags': None, 'mid': None, 'mname': None, 'img': None}
+        note = {'nid': None, 'flds': None, 'tags': None, 'mid': None, 'mname': None, 'img': None, 'match': None}
         
         flds = u' '.join(n['flds'])
         
@@ -88,16 +67,110 @@ def db_cards(at, did):
         note['tags']  = n['tags']
         note['mid']   = n['mid']
         note['mname'] = n['mname']
-        if n['img']:
-            from PIL import Image
-            img = create_thumb(n['img'], Image)
-            note['img']   = img
+        note['img']   = n['img']
+        # match keys for Workflow.filter, worked out once here
+        note['match'] = wf.prepare_key(card_key(note)).pack()
         
         results.append(note)
     
     return results
 
 
+# --------------------------------------------
+# Patch cached cards with notes changed since
+# the marks stored for the cache
+
+def patch_cards(at, did, cards, since):
+    
+    changed = dict((c['nid'], c) for c in db_cards(at, did, since))
+    live = at.deck_nids(did)
+    log.debug('{} changed anki notes'.format(len(changed)))
+    
+    results = []
+    for card in cards:
+        # deleted notes, or cards moved to another deck
+        if card['nid'] not in live:
+            continue
+        results.append(changed.pop(card['nid'], card))
+    
+    # notes new to the deck
+    results.extend(changed.values())
+    return results
+
+
+# --------------------------------------------
+# Decks whose card caches are worth warming before
+# they're opened: most entered first (anki.py counts
+# them in deck_usage), then most due, then biggest
+
+PREFETCH = 5
+
+def prefetch_order(decks, state):
+    usage = wf.stored_data('deck_usage') or {}
+
+    stale = []
+    for d in decks:
+        did = str(d['id'])
+        if not d['cards']:
+            continue
+        if wf.cached_data('{}.colstate'.format(did), None, max_age=0) == state:
+            continue
+        due = d['new'] + d['lrn'] + d['rev']
+        stale.append((usage.get(did, 0), due, d['cards'], did))
+
+    stale.sort(reverse=True)
+    return [did for _, _, _, did in stale[:PREFETCH]]
+
+
+# --------------------------------------------
+# Refresh one deck's card cache, the cards-<did>
+# job lib/arefresh.py starts
+
+def refresh_deck(did):
+    
+    marks_name = '{}.marks'.format(did)
+
+    since = wf.cached_data(marks_name, None, max_age=0)
+    cards = wf.cached_data(did, None, max_age=0, serializer='columns')
+
+    # caches from before the match keys are built again
+    if cards and 'match' not in cards[0]:
+        cards = None
+
+    # state is read before the snapshot, marks, notes and
+    # models all come from it. Anything written meanwhile
+    # is picked up again by the next refresh
+    state = col_state(at.col)
+    with at.snapshot():
+        marks = at.deck_marks(str(did))
+        # decks moved under this one bring notes of any age
+        if since and set(marks['dids']) - set(since.get('dids', ())):
+            since = None
+        if since and cards is not None:
+            cards = patch_cards(at, str(did), cards, since)
+        else:
+            cards = db_cards(at, str(did))
+
+    # cards are published before their thumbnails
+    wf.cache_data(did, cards, serializer='columns')
+    wf.cache_data(marks_name, marks)
+    wf.cache_data('{}.colstate'.format(did), state)
+    log.debug('{} anki cards cached'.format(len(cards)))
+
+    # search index next to the cache, stamped with its mtime
+    from lib.aindex import CardIndex, card_key
+    cache = wf.cachefile('{}.columns'.format(did))
+    CardIndex.build(wf.cachefile('{}.index'.format(did)),
+                    (card_key(c) for c in cards),
+                    wf.fold_to_ascii,
+                    os.stat(cache).st_mtime)
+    print('Deck updated')
+
+    if any(c['img'] for c in cards):
+        from lib.arefresh import refresh_thumbs
+        refresh_thumbs(wf, did)
+
+
 def main(wf):
     from docopt import docopt
     args = docopt(__usage__, argv=wf.args)
@@ -111,27 +184,68 @@ def main(wf):
     
     if args.get('decks'):
 
-        def wrapper():
-            return db_decks(at)
+        from lib.adecks import DeckStore
 
-        decks = wf.cached_data('decks', wrapper, max_age=1)
-        log.debug('{} anki decks cached'.format(len(decks)))
+        state = col_state(at.col)
+        store = DeckStore(wf.cachefile('decks.db'))
+        with at.snapshot():
+            changed = store.update(at)
+        wf.cache_data('decks.colstate', state)
+        log.debug('{} anki decks changed'.format(changed))
         print('Collection updated')
+
+        from lib.arefresh import prefetch
+        dids = prefetch_order(store.decks(), state)
+        log.debug('Prefetching cards for {} decks'.format(len(dids)))
+        prefetch(wf, dids)
         
         
     # --------------------------------------------
     # Update Cards
     
     if args.get('cards'):
-        
-        did = wf.cached_data('did', None, max_age=0)
+        try:
+            refresh_deck(args['<did>'])
+        finally:
+            # this job's slot goes to the next queued deck
+            from lib.arefresh import start_next
+            start_next(wf)
+
+
+    # --------------------------------------------
+    # Update thumbnails for the queued decks' cached cards
+
+    if args.get('thumbs'):
+        from lib.arefresh import next_thumbs
+
+        # decks queued while this job runs are done by it too
+        did = next_thumbs(wf)
+        while did is not None:
+            cards = wf.cached_view(did, serializer='columns')
+            if cards is not None:
+                thumbs = db_thumbs([img for img in cards.column('img') if img])
+                # swapped in whole, anki.py never sees a partial map
+                wf.cache_data('{}.thumbs'.format(did), thumbs)
+            did = next_thumbs(wf)
+        print('Thumbnails updated')
+
+
+    # --------------------------------------------
+    # Update full-collection search index
 
-        def wrapper():
-            return db_cards(at, str(did))
+    if args.get('search'):
+        from lib.asearch import SearchIndex
 
-        cards = wf.cached_data(did, wrapper, max_age=1)
-        log.debug('{} anki cards cached'.format(len(cards)))
-        print('Deck updated')
+        state = col_state(at.col)
+        stat = col_stat(at.col)
+        index = SearchIndex(wf.cachefile('search.db'))
+        with at.snapshot():
+            count = index.update(at)
+        wf.cache_data('search.colstate', state)
+        # anki.py's :afind only compares stats, see col_touched
+        wf.cache_data('search.colstat', stat)
+        log.debug('{} notes indexed for search'.format(count))
+        print('Search index updated')
 
 
 
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+########################################################
+# Column cache format for the deck and card caches.
+#
+# A list of flat dicts with the same keys is stored one
+# column per key instead of one pickled dict per record:
+#
+#   'AWC1' rows:u32 cols:u32
+#   per column   kind:char namelen:u16 name offset:u64
+#   'q'          rows x int64
+#   'u'/'b'      text block of rows values
+#   'U'/'B'      distinct:u32, text block of the distinct
+#                values, rows x u32 indexes into them
+#   text block   null flags, offsets:u32, NUL-ended utf-8
+#
+# 'u' columns load as unicode, 'b' columns as str. Columns
+# reads a single column or row straight from the buffer
+# (a str or an mmap), so callers needn't decode all of it.
+# Workflow.cached_view(name, serializer='columns') maps the
+# cache file and returns a Columns.
+
+import struct
+from itertools import izip
+
+from workflow.workflow import manager
+
+
+MAGIC = 'AWC1'
+HEADER = struct.Struct('<4sII')
+COLUMN = struct.Struct('<cH')
+OFFSET = struct.Struct('<Q')
+UINT = struct.Struct('<I')
+SPAN = struct.Struct('<II')
+
+
+def _kind(values):
+    '''Column type for ``values``, ints or strings/None'''
+    if all(isinstance(v, (int, long)) and not isinstance(v, bool) for v in values):
+        return 'q'
+    if all(v is None or isinstance(v, str) for v in values):
+        kind = 'b'
+    elif all(v is None or isinstance(v, basestring) for v in values):
+        kind = 'u'
+    else:
+        raise TypeError('Column values must be all ints, or all strings/None')
+
+    # few distinct values (model names, tags), store each once
+    if len(set(values)) * 2 <= len(values):
+        return kind.upper()
+    return kind
+
+
+def _text(values):
+    '''Text block for ``values``'''
+    flags, offsets, blob, end = [], [0], [], 0
+    for v in values:
+        flags.append('\x01' if v is None else '\x00')
+        if isinstance(v, unicode):
+            v = v.encode('utf-8')
+        v = (v or '') + '\x00'
+        blob.append(v)
+        end += len(v)
+        offsets.append(end)
+
+    return (''.join(flags) +
+            struct.pack('<{}I'.format(len(offsets)), *offsets) +
+            ''.join(blob))
+
+
+def _pack(kind, values):
+    if kind == 'q':
+        return struct.pack('<{}q'.format(len(values)), *values)
+
+    if kind in 'ub':
+        return _text(values)
+
+    distinct = {}
+    for v in values:
+        distinct.setdefault(v, len(distinct))
+    ordered = sorted(distinct, key=distinct.get)
+    return (UINT.pack(len(ordered)) + _text(ordered) +
+            struct.pack('<{}I'.format(len(values)), *(distinct[v] for v in values)))
+
+
+def _read_text(buf, pos, n, decode):
+    '''Values of the text block at ``pos`` and where it ends'''
+    flags = buf[pos:pos + n]
+    offsets = struct.unpack_from('<{}I'.format(n + 1), buf, pos + n)
+    start = pos + n + 4 * (n + 1)
+    blob = buf[start:start + offsets[n]]
+
+    # NUL-ended values decode and split in one go, unless a value has a NUL
+    values = (blob.decode('utf-8') if decode else blob).split('\x00')[:-1]
+    if len(values) != n:
+        values = [blob[offsets[i]:offsets[i + 1] - 1] for i in xrange(n)]
+        if decode:
+            values = [v.decode('utf-8') for v in values]
+
+    i = flags.find('\x01')
+    while i != -1:
+        values[i] = None
+        i = flags.find('\x01', i + 1)
+
+    return values, start + offsets[n]
+
+
+def _text_value(buf, pos, n, i, decode):
+    '''Value ``i`` of the text block at ``pos``'''
+    if buf[pos + i] == '\x01':
+        return None
+    a, b = SPAN.unpack_from(buf, pos + n + 4 * i)
+    start = pos + n + 4 * (n + 1)
+    v = buf[start + a:start + b - 1]
+    return v.decode('utf-8') if decode else v
+
+
+def _text_end(buf, pos, n):
+    '''Where the text block at ``pos`` ends'''
+    start = pos + n + 4 * (n + 1)
+    return start + UINT.unpack_from(buf, start - 4)[0]
+
+
+
+class Columns(object):
+    '''Read-only view of a column cache in ``buf``'''
+
+    def __init__(self, buf):
+        self.buf = buf
+
+        magic, self.count, ncols = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a column cache')
+
+        self.names = []
+        self._cols = {}
+        pos = HEADER.size
+        for _ in xrange(ncols):
+            kind, size = COLUMN.unpack_from(buf, pos)
+            pos += COLUMN.size
+            name = buf[pos:pos + size]
+            pos += size
+            offset, = OFFSET.unpack_from(buf, pos)
+            pos += OFFSET.size
+            self.names.append(name)
+            self._cols[name] = (kind, offset)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __iter__(self):
+        names = self.names
+        for row in izip(*[self.column(name) for name in names]):
+            yield dict(izip(names, row))
+
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('Row out of range')
+        return dict((name, self.value(name, i)) for name in self.names)
+
+
+    def column(self, name):
+        '''All values of column ``name``'''
+        kind, pos = self._cols[name]
+        n = self.count
+
+        if kind == 'q':
+            return list(struct.unpack_from('<{}q'.format(n), self.buf, pos))
+
+        if kind in 'ub':
+            return _read_text(self.buf, pos, n, kind == 'u')[0]
+
+        m, = UINT.unpack_from(self.buf, pos)
+        distinct, end = _read_text(self.buf, pos + 4, m, kind == 'U')
+        return [distinct[j] for j in struct.unpack_from('<{}I'.format(n), self.buf, end)]
+
+
+    def pick(self, name, rows):
+        '''Values of column ``name`` in ``rows``'''
+        if len(rows) * 4 > self.count:
+            values = self.column(name)
+            return [values[i] for i in rows]
+        return [self.value(name, i) for i in rows]
+
+
+    def value(self, name, i):
+        '''Value of column ``name`` in row ``i``'''
+        kind, pos = self._cols[name]
+        n = self.count
+
+        if kind == 'q':
+            return struct.unpack_from('<q', self.buf, pos + 8 * i)[0]
+
+        if kind in 'ub':
+            return _text_value(self.buf, pos, n, i, kind == 'u')
+
+        m, = UINT.unpack_from(self.buf, pos)
+        j, = UINT.unpack_from(self.buf, _text_end(self.buf, pos + 4, m) + 4 * i)
+        return _text_value(self.buf, pos + 4, m, j, kind == 'U')
+
+
+
+class ColumnSerializer(object):
+    '''Serializer for lists of flat dicts that share their keys,
+       registered as ``columns``'''
+
+    @classmethod
+    def load(cls, file_obj):
+        return list(Columns(file_obj.read()))
+
+
+    @classmethod
+    def view(cls, buf):
+        return Columns(buf)
+
+
+    @classmethod
+    def dump(cls, obj, file_obj):
+        names = sorted(obj[0]) if obj else []
+
+        cols = []
+        for name in names:
+            values = [record[name] for record in obj]
+            kind = _kind(values)
+            cols.append((name, kind, _pack(kind, values)))
+
+        offset = HEADER.size + sum(COLUMN.size + len(name) + OFFSET.size
+                                   for name in names)
+
+        file_obj.write(HEADER.pack(MAGIC, len(obj), len(names)))
+        for name, kind, data in cols:
+            file_obj.write(COLUMN.pack(kind, len(name)) + name + OFFSET.pack(offset))
+            offset += len(data)
+        for name, kind, data in cols:
+            file_obj.write(data)
+
+
+manager.register('columns', ColumnSerializer)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+########################################################
+# Deck list backed by a sidecar database in the workflow
+# cache dir, decks.db. background.py decks keeps its
+# deck_summary table up to date in one transaction,
+# writing only the decks that changed. The script filter
+# and the server read it, in WAL mode, without waiting
+# on the writer or on each other.
+
+import os, sqlite3
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deck_summary (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    parent INTEGER,
+    depth INTEGER,
+    cards INTEGER,
+    new INTEGER,
+    lrn INTEGER,
+    rev INTEGER,
+    mod INTEGER);
+"""
+
+COLUMNS = ('id', 'name', 'parent', 'depth', 'cards', 'new', 'lrn', 'rev', 'mod')
+TIMEOUT = 10.0
+
+
+def summary_rows(decks):
+    '''deck_summary rows for Tools.deck_summary()'s decks'''
+    ids = dict((d['name'], d['id']) for d in decks)
+
+    rows = []
+    for d in decks:
+        name = d['name']
+        parent = ids.get(name.rsplit('::', 1)[0]) if '::' in name else None
+        rows.append((int(d['id']), name, parent, name.count('::'), d['cards'],
+                     d['new'], d['learning'], d['review'], d['mod']))
+    return rows
+
+
+
+class DeckStore(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=TIMEOUT)
+
+
+    def update(self, at):
+        '''Write the decks that changed, drop the ones that are
+           gone. Returns rows written or deleted.'''
+
+        rows = summary_rows(at.deck_summary())
+
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode = WAL")
+            db.executescript(SCHEMA)
+
+            # autocommit, the transaction is ours to begin and end
+            db.isolation_level = None
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                old = dict((r[0], r) for r in db.execute("SELECT {} FROM deck_summary"
+                                                         .format(', '.join(COLUMNS))))
+                changed = [r for r in rows if old.pop(r[0], None) != r]
+                # renamed decks free their name before it's taken again
+                db.executemany("DELETE FROM deck_summary WHERE id = ?",
+                               [(i,) for i in old] + [(r[0],) for r in changed])
+                db.executemany("INSERT INTO deck_summary VALUES ({})"
+                               .format(', '.join('?' * len(COLUMNS))), changed)
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+        return len(changed) + len(old)
+
+
+    def _select(self, where='', args=()):
+        if not os.path.exists(self.path):
+            return None
+
+        db = self._connect()
+        try:
+            rows = db.execute("SELECT {} FROM deck_summary {}"
+                              .format(', '.join(COLUMNS), where), args).fetchall()
+        except sqlite3.OperationalError:
+            return None     # not created yet
+        finally:
+            db.close()
+
+        return [dict(zip(COLUMNS, r)) for r in rows]
+
+
+    def decks(self):
+        '''All decks as dicts by name, or None before the first update'''
+        return self._select("ORDER BY name")
+
+
+    def deck_id(self, name):
+        '''Id of the deck called ``name``, from the name index'''
+        rows = self._select("WHERE name = ?", (name,))
+        return rows[0]['id'] if rows else None
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+########################################################
+# On-disk search index for the per-deck card caches.
+#
+# Maps 2 and 3 character grams of each card's search key
+# to the rows (positions) of the cached card list. Grams
+# are taken from the folded text, the atom initials and
+# the capitals, so every card Workflow.filter could match
+# with MATCH_ALL ^ MATCH_ALLCHARS is among the candidates.
+
+import os, sqlite3
+from array import array
+
+from workflow.workflow import INITIALS, split_on_delimiters
+
+
+def search_key(flds, tags):
+    '''Search key for a card's fields and tags, fields + #tags'''
+    tags = u' '.join(u'#' + t for t in tags.split())
+    return u'{} {}'.format(flds, tags)
+
+
+def card_key(card):
+    '''Search key for a cached card'''
+    return search_key(card['flds'], card['tags'])
+
+
+def _sources(value, fold):
+    '''Lower-cased strings the filter rules match against'''
+    value = fold(value.strip())
+    atoms = [s.lower() for s in split_on_delimiters(value)]
+    return (('t', value.lower()),
+            ('i', ''.join(s[0] for s in atoms if s)),
+            ('c', ''.join(c for c in value if c in INITIALS).lower()))
+
+
+def _grams(text):
+    grams = set()
+    for n in (2, 3):
+        for i in range(len(text) - n + 1):
+            grams.add(text[i:i+n])
+    return grams
+
+
+def _query_grams(word):
+    if len(word) <= 3:
+        return [word]
+    return [word[i:i+3] for i in range(len(word) - 2)]
+
+
+class CardIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+    @classmethod
+    def build(cls, path, keys, fold, stamp):
+        '''Write the index for ``keys`` (one per cached card, in
+           cache order). ``stamp`` is the mtime of the card cache
+           the rows refer to.'''
+
+        postings = {}
+        count = 0
+        for row, key in enumerate(keys):
+            count += 1
+            for src, text in _sources(key, fold):
+                for gram in _grams(text):
+                    rows = postings.get(src + gram)
+                    if rows is None:
+                        rows = postings[src + gram] = array('I')
+                    rows.append(row)
+
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+        db = sqlite3.connect(tmp)
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value)")
+        db.execute("CREATE TABLE postings (gram TEXT PRIMARY KEY, rows BLOB)")
+        db.executemany("INSERT INTO meta VALUES (?, ?)",
+                       (('stamp', stamp), ('count', count)))
+        db.executemany("INSERT INTO postings VALUES (?, ?)",
+                       ((g, sqlite3.Binary(r.tostring())) for g, r in postings.iteritems()))
+        db.commit()
+        db.close()
+
+        os.rename(tmp, path)
+
+
+    def candidates(self, query, stamp):
+        '''Sorted rows that may match ``query``, or None if
+           the index is missing/stale or can't narrow the query'''
+
+        if not os.path.exists(self.path):
+            return None
+
+        words = [w.lower() for w in query.split() if len(w) > 1]
+        if not words:
+            return None
+
+        try:
+            words = [w.encode('ascii') for w in words]
+        except UnicodeError:
+            # non-ASCII queries aren't folded by the filter
+            return None
+
+        db = sqlite3.connect(self.path)
+        try:
+            meta = dict(db.execute("SELECT key, value FROM meta"))
+            if meta.get('stamp') != stamp:
+                return None
+
+            grams = set()
+            for word in words:
+                for src in 'tic':
+                    grams.update(src + g for g in _query_grams(word))
+
+            postings = {}
+            sql = "SELECT gram, rows FROM postings WHERE gram IN ({})"
+            rows = db.execute(sql.format(','.join('?' * len(grams))), list(grams))
+            for gram, blob in rows:
+                a = array('I')
+                a.fromstring(str(blob))
+                postings[gram] = a
+        finally:
+            db.close()
+
+        result = None
+        for word in words:
+            matches = set()
+            for src in 'tic':
+                found = None
+                for g in _query_grams(word):
+                    rows = postings.get(src + g, ())
+                    found = set(rows) if found is None else found.intersection(rows)
+                    if not found:
+                        break
+                matches.update(found)
+
+            result = matches if result is None else result & matches
+            if not result:
+                break
+
+        return sorted(result)
@@ -0,0 +1,412 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+########################################################
+# Batch matching for prepared keys (Workflow.prepare_key).
+#
+# Workflow.filter runs its MATCH_* rules one item at a time,
+# through a key function and a couple of method calls per
+# item and word. BatchMatcher keeps the prepared parts of
+# all items in flat columns (lower key, capitals, initials,
+# atom sets, sort keys) and runs each query word over the
+# rows still in the running as one tight loop of C-level
+# string tests:
+#
+#   startswith, substring     lower
+#   capitals                  capitals
+#   atom                      atom set
+#   initials                  initials
+#   allchars                  char set, then the filter's regex
+#
+# With numpy, the columns are also packed into NUL-separated
+# byte buffers (_Column) and each word is tested against
+# every row at once: the word's positions come from the
+# sorted positions of its first byte, narrowed a byte at a
+# time, and map to rows with searchsorted. Allchars walks
+# the next position of each of the word's bytes for all
+# remaining rows together; the regex is only run for rows
+# with a newline, where '.' stops. Row lists shorter than
+# PACKED_MIN (index candidates, typing on) use the loop.
+#
+# The scores use the same rules, order and arithmetic as
+# Workflow.filter, so results and ranking are exactly the
+# filter's. Queries the columns can't answer (non-ASCII
+# words, folding turned off) go through Workflow.filter.
+#
+#   python amatch.py [items]    benchmark against filter
+#
+# Building the columns costs about as much as one filter
+# run, so anki.py only uses it from server.py, which keeps
+# a deck's matcher between keystrokes.
+
+import heapq
+from array import array
+
+try:
+    import numpy
+except ImportError:     # the loop below does without
+    numpy = None
+
+from workflow.workflow import (MATCH_STARTSWITH, MATCH_CAPITALS, MATCH_ATOM,
+                               MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN,
+                               MATCH_SUBSTRING, MATCH_ALLCHARS, MATCH_ALL, isascii)
+
+PACKED_MIN = 2000   # fewer rows are matched faster by the loop
+
+
+class _Column(object):
+    '''``values`` (ASCII) as one NUL-separated numpy byte buffer'''
+
+    def __init__(self, values):
+        data = '\x00'.join([v.encode('ascii') for v in values]) + '\x00'
+        self.buf = numpy.frombuffer(data, numpy.uint8)
+        self.lens = numpy.fromiter((len(v) for v in values), numpy.int64, len(values))
+        self.starts = numpy.zeros(len(values), numpy.int64)
+        numpy.cumsum(self.lens[:-1] + 1, out=self.starts[1:])
+        self.ends = self.starts + self.lens
+        self._at = {}
+
+
+    def at(self, c):
+        '''Sorted positions of character ``c``'''
+        pos = self._at.get(c)
+        if pos is None:
+            pos = self._at[c] = numpy.flatnonzero(self.buf == ord(c)).astype(numpy.int32)
+        return pos
+
+
+    def find(self, word):
+        '''Positions of ``word``'''
+        buf, pos = self.buf, self.at(word[0])
+        for j in xrange(1, len(word)):
+            pos = pos[pos + j < len(buf)]
+            pos = pos[buf[pos + j] == ord(word[j])]
+        return pos
+
+
+    def rows(self, pos):
+        return numpy.searchsorted(self.starts, pos, 'right') - 1
+
+
+    def match(self, word):
+        '''Rows containing ``word``, rows starting with it'''
+        pos = self.find(word)
+        rows = self.rows(pos)
+        contains = numpy.zeros(len(self.lens), bool)
+        contains[rows] = True
+        starts = numpy.zeros(len(self.lens), bool)
+        starts[rows[pos == self.starts[rows]]] = True
+        return contains, starts
+
+
+    def atom(self, word):
+        '''Rows with ``word`` between spaces, the column holds
+           each row's atoms joined by spaces'''
+        buf, pos = self.buf, self.find(word)
+        rows = self.rows(pos)
+        edge = (pos == self.starts[rows]) | (buf[pos - 1] == 32)
+        end = buf[pos + len(word)]
+        edge &= (end == 32) | (end == 0)
+        atom = numpy.zeros(len(self.lens), bool)
+        atom[rows[edge]] = True
+        return atom
+
+
+
+class _Packed(object):
+    '''A BatchMatcher's columns as _Columns, every row is scored
+       with whole-column numpy operations'''
+
+    def __init__(self, matcher):
+        self.lower = _Column(matcher.lower)
+        self.capitals = _Column(matcher.capitals)
+        self.initials = _Column(matcher.initials)
+        self.atoms = _Column([u' '.join(sorted(a)) for a in matcher.atoms])
+        self.valid = numpy.fromiter((bool(k) for k in matcher.sortkeys), bool,
+                                    len(matcher.sortkeys))
+        # '.' in the allchars regex stops at newlines
+        self.newline = numpy.zeros(len(matcher.keys), bool)
+        self.newline[self.lower.rows(self.lower.at('\n'))] = True
+
+
+    def _allchars(self, wf, keys, word, rest, scores, rules):
+        '''Allchars scores of the ``rest`` rows, the regex matches
+           from the start up to the next of each char in turn'''
+        col = self.lower
+        rows = numpy.flatnonzero(rest & ~self.newline)
+        pos, ends = col.starts[rows], col.ends[rows]
+        for c in word:
+            at = col.at(c)
+            if not len(at):
+                rows = rows[:0]
+                break
+            i = numpy.searchsorted(at, pos)
+            keep = i < len(at)
+            rows, ends, i = rows[keep], ends[keep], i[keep]
+            nxt = at[i]
+            keep = nxt < ends
+            rows, ends, pos = rows[keep], ends[keep], nxt[keep] + 1
+
+        if len(rows):
+            # m.start() is 0, m.end() is pos
+            scores[rows] = 100.0 / (pos - col.starts[rows] + 1)
+            rules[rows] = MATCH_ALLCHARS
+
+        search = wf._search_for_query(word)
+        for row in numpy.flatnonzero(rest & self.newline):
+            m = search(keys[row].folded)
+            if m:
+                scores[row] = 100.0 / ((1 + m.start()) * (m.end() - m.start() + 1))
+                rules[row] = MATCH_ALLCHARS
+
+
+    def _word(self, wf, keys, word, allowed, match_on):
+        '''Scores and rules of all rows for one lower-case ASCII
+           word, rows not ``allowed`` score 0'''
+
+        q = len(word)
+        conds, scores, rules = [], [], []
+
+        in_lower, sw_lower = self.lower.match(word)
+        if match_on & MATCH_STARTSWITH:
+            conds.append(sw_lower)
+            scores.append(100.0 - (self.lower.lens // q))
+            rules.append(MATCH_STARTSWITH)
+        if match_on & MATCH_CAPITALS:
+            conds.append(self.capitals.match(word)[1])
+            scores.append(100.0 - (self.capitals.lens // q))
+            rules.append(MATCH_CAPITALS)
+        if match_on & MATCH_ATOM:
+            conds.append(self.atoms.atom(word))
+            scores.append(100.0 - (self.lower.lens // q))
+            rules.append(MATCH_ATOM)
+        if match_on & (MATCH_INITIALS_STARTSWITH | MATCH_INITIALS_CONTAIN):
+            in_ini, sw_ini = self.initials.match(word)
+            if match_on & MATCH_INITIALS_STARTSWITH:
+                conds.append(sw_ini)
+                scores.append(100.0 - (self.initials.lens // q))
+                rules.append(MATCH_INITIALS_STARTSWITH)
+            if match_on & MATCH_INITIALS_CONTAIN:
+                conds.append(in_ini)
+                scores.append(95.0 - (self.initials.lens // q))
+                rules.append(MATCH_INITIALS_CONTAIN)
+        if match_on & MATCH_SUBSTRING:
+            conds.append(in_lower)
+            scores.append(90.0 - (self.lower.lens // q))
+            rules.append(MATCH_SUBSTRING)
+
+        n = len(self.valid)
+        if conds:
+            conds = [c & allowed for c in conds]
+            s = numpy.select(conds, scores, 0.0)
+            r = numpy.select(conds, [numpy.full(n, v, numpy.int64) for v in rules], 0)
+        else:
+            s, r = numpy.zeros(n), numpy.zeros(n, numpy.int64)
+
+        if match_on & MATCH_ALLCHARS:
+            self._allchars(wf, keys, word, allowed & (r == 0), s, r)
+        return s, r
+
+
+    def filter(self, wf, keys, sortkeys, words, allowed, match_on, max_results, matched):
+        '''(row, score, rule) of the ``allowed`` rows matching all
+           ``words``, ranked as Workflow.filter ranks them'''
+
+        total = rule = None
+        for word in words:
+            s, r = self._word(wf, keys, word, allowed, match_on)
+            allowed = allowed & (s != 0)
+            total = s if total is None else total + s
+            rule = r
+            if not allowed.any():
+                break
+
+        hits = numpy.flatnonzero(allowed & (total != 0) & self.valid)
+        if matched is not None:
+            matched.extend(hits.tolist())
+
+        # the max_results best keys, plus any tied with the last
+        order = 100.0 / total[hits]
+        if max_results and len(hits) > max_results:
+            kth = numpy.partition(order, max_results - 1)[max_results - 1]
+            hits = hits[order <= kth]
+
+        results = [((100.0 / score, sortkeys[row], score), (row, score, rule))
+                   for row, score, rule in zip(hits.tolist(), total[hits].tolist(),
+                                               rule[hits].tolist())]
+        results.sort()
+        if max_results:
+            results = results[:max_results]
+        return [t[1] for t in results]
+
+
+class BatchMatcher(object):
+    '''Matches queries against ``keys``, a list of MatchKeys'''
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.lower = [k.lower for k in keys]
+        self.capitals = [k.capitals for k in keys]
+        self.initials = [k.initials for k in keys]
+        self.atoms = [frozenset(k.atoms) for k in keys]
+        self.sortkeys = [k.value.strip().lower() for k in keys]
+        self._chars = None
+
+        self._packed = None
+        if numpy is not None and keys:
+            try:
+                self._packed = _Packed(self)
+            except UnicodeError:
+                pass    # keys that weren't folded, the loop handles them
+
+
+    def _word(self, wf, word, rows, match_on):
+        '''{row: (score, rule)} of ``rows`` for one lower-case ASCII word'''
+
+        q = len(word)
+        lowers, capitals, initials, atoms = self.lower, self.capitals, self.initials, self.atoms
+        use_atoms = match_on & MATCH_ATOM
+        use_allchars = match_on & MATCH_ALLCHARS
+        if use_allchars:
+            if self._chars is None:
+                self._chars = [frozenset(l) for l in lowers]
+            chars, wordset = self._chars, set(word)
+            search = wf._search_for_query(word)
+
+        # the rules in Workflow._score_key's order, py2 int division
+        scores = {}
+        for row in rows:
+            lower, caps, ini = lowers[row], capitals[row], initials[row]
+            if word not in lower and word not in caps and word not in ini:
+                if use_allchars and wordset <= chars[row]:
+                    m = search(self.keys[row].folded)
+                    if m:
+                        scores[row] = (100.0 / ((1 + m.start()) * (m.end() - m.start() + 1)),
+                                       MATCH_ALLCHARS)
+                continue
+
+            if match_on & MATCH_STARTSWITH and lower.startswith(word):
+                scores[row] = (100.0 - (len(lower) / q), MATCH_STARTSWITH)
+            elif match_on & MATCH_CAPITALS and caps.startswith(word):
+                scores[row] = (100.0 - (len(caps) / q), MATCH_CAPITALS)
+            elif use_atoms and word in atoms[row]:
+                scores[row] = (100.0 - (len(lower) / q), MATCH_ATOM)
+            elif match_on & MATCH_INITIALS_STARTSWITH and ini.startswith(word):
+                scores[row] = (100.0 - (len(ini) / q), MATCH_INITIALS_STARTSWITH)
+            elif match_on & MATCH_INITIALS_CONTAIN and word in ini:
+                scores[row] = (95.0 - (len(ini) / q), MATCH_INITIALS_CONTAIN)
+            elif match_on & MATCH_SUBSTRING and word in lower:
+                scores[row] = (90.0 - (len(lower) / q), MATCH_SUBSTRING)
+            elif use_allchars:
+                m = search(self.keys[row].folded)
+                if m:
+                    scores[row] = (100.0 / ((1 + m.start()) * (m.end() - m.start() + 1)),
+                                   MATCH_ALLCHARS)
+        return scores
+
+
+    def _allowed(self, rows):
+        '''``rows`` as a mask over all rows'''
+        allowed = numpy.zeros(len(self.keys), bool)
+        if isinstance(rows, xrange) and len(rows) == len(self.keys):
+            allowed[:] = True
+        elif isinstance(rows, array):
+            allowed[numpy.frombuffer(rows, numpy.dtype(rows.typecode))] = True
+        else:
+            allowed[numpy.fromiter(rows, numpy.int64)] = True
+        return allowed
+
+
+    def filter(self, wf, query, rows=None, match_on=MATCH_ALL, max_results=0,
+               include_score=False, matched=None):
+        '''``rows`` of ``keys`` (default all) matching ``query``,
+           same results as wf.filter(query, rows, keys.__getitem__, ...)'''
+
+        if rows is None:
+            rows = xrange(len(self.keys))
+
+        words = query.lower().split()
+        if (not all(isascii(w) for w in words) or
+                not wf.settings.get('__workflow_diacritic_folding', True)):
+            return wf.filter(query, rows, self.keys.__getitem__,
+                             match_on=match_on, max_results=max_results,
+                             include_score=include_score, matched=matched)
+        if not words:
+            raise ValueError('`query` contains only whitespace')
+
+        if self._packed is not None and len(rows) >= PACKED_MIN:
+            results = self._packed.filter(wf, self.keys, self.sortkeys, words,
+                                          self._allowed(rows), match_on,
+                                          max_results, matched)
+            if include_score:
+                return results
+            return [t[0] for t in results]
+
+        totals = None
+        for word in words:
+            scores = self._word(wf, word, rows, match_on)
+            if totals is None:
+                totals = dict((row, [s, rule]) for row, (s, rule) in scores.iteritems() if s)
+            else:
+                for row in totals.keys():
+                    s, rule = scores.get(row, (0, None))
+                    if not s:
+                        del totals[row]
+                    else:
+                        totals[row][0] += s
+                        totals[row][1] = rule
+            if not totals:
+                break
+            rows = totals.keys()
+
+        sortkeys = self.sortkeys
+        results = [((100.0 / score, sortkeys[row], score), (row, score, rule))
+                   for row, (score, rule) in totals.iteritems()
+                   if score and sortkeys[row]]
+
+        if matched is not None:
+            matched.extend(sorted(t[1][0] for t in results))
+
+        if max_results:
+            results = heapq.nsmallest(max_results, results)
+        else:
+            results.sort()
+        results = [t[1] for t in results]
+
+        if include_score:
+            return results
+        return [t[0] for t in results]
+
+
+if __name__ == '__main__':
+    import sys, time, random
+    from workflow import Workflow, MATCH_ALL, MATCH_ALLCHARS
+
+    wf = Workflow()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    random.seed(0)
+    words = [u'hola', u'mundo', u'Spanish', u'verb', u'Irregular', u'ser', u'estar',
+             u'caf\xe9', u'ni\xf1o', u'OmniFocus', u'back', u'front', u'#t1', u'#Verb']
+    values = [u' '.join(random.choice(words) for _ in range(random.randint(2, 10))) + u' %d' % i
+              for i in xrange(count)]
+    keys = [wf.prepare_key(v) for v in values]
+
+    t = time.time()
+    matcher = BatchMatcher(keys)
+    print('{} keys, packed in {:.3f}s, {}'.format(count, time.time() - t,
+          'numpy' if matcher._packed is not None else 'no numpy, loop only'))
+
+    for match_on in (MATCH_ALL ^ MATCH_ALLCHARS, MATCH_ALL):
+        matcher.filter(wf, u'warm', match_on=match_on)  # char sets are made on first use
+        for query in (u'hola', u'omni', u'sv', u'12345', u'ser est', u'#t1 ba', u'caf\xe9', u'xq'):
+            t = time.time()
+            slow = wf.filter(query, range(count), keys.__getitem__,
+                             match_on=match_on, max_results=50, include_score=True)
+            slow_t = time.time() - t
+            t = time.time()
+            fast = matcher.filter(wf, query, match_on=match_on, max_results=50,
+                                  include_score=True)
+            fast_t = time.time() - t
+            print('{:<8} allchars={:<5} filter {:.3f}s  batch {:.3f}s  x{:<6.1f} {}'.format(
+                  query.encode('utf-8'), bool(match_on & MATCH_ALLCHARS), slow_t, fast_t,
+                  slow_t / max(fast_t, 1e-6), 'same' if slow == fast else 'DIFFERENT'))
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+########################################################
+# Background refreshes of the per-deck card caches.
+#
+# Each deck gets its own job, cards-<did>, which is
+# handed the deck id on its command line. A deck that's
+# already refreshing isn't started twice, and at most
+# MAX_JOBS decks refresh at once. Decks over the cap are
+# queued as empty cards-<did>.queued files in the cache
+# dir; a finishing job starts the oldest one. Creating
+# and deleting a file are atomic, so queueing the same
+# deck twice is harmless and only one job takes it.
+#
+# prefetch() warms decks the user hasn't opened yet, as
+# cards-<did>.prefetch files holding their rank. They run
+# one at a time when nothing is queued, and always leave
+# a slot free for a deck the user opens.
+#
+# Thumbnails are made by a single thumbs job, so only one
+# process pool writes the thumbs dir and its store. Decks
+# ask for theirs with thumbs-<did>.queued files, the job
+# takes them oldest first until none are left.
+
+import os, glob
+
+from workflow.background import run_in_background, is_running
+
+MAX_JOBS = 2
+
+
+def _name(did):
+    return 'cards-{}'.format(did)
+
+
+def _queued(wf, did):
+    return wf.cachefile('{}.queued'.format(_name(did)))
+
+
+def _prefetched(wf, did):
+    return wf.cachefile('{}.prefetch'.format(_name(did)))
+
+
+def _did(path):
+    return os.path.basename(path)[len(_name('')):].rsplit('.', 1)[0]
+
+
+def _unlink(path):
+    '''Delete marker ``path``, False if it was already gone'''
+    try:
+        os.unlink(path)
+    except OSError:
+        return False
+    return True
+
+
+def _start(wf, did):
+    cmd = ['/usr/bin/python', wf.workflowfile('background.py'), 'cards', str(did)]
+    run_in_background(_name(did), cmd)
+
+
+def running(wf):
+    '''Deck ids with a card refresh running'''
+    dids = []
+    for pidfile in glob.glob(wf.cachefile(_name('*') + '.pid')):
+        did = _did(pidfile)
+        if is_running(_name(did)):
+            dids.append(did)
+    return dids
+
+
+def refreshing(wf, did):
+    '''Is deck ``did`` refreshing or waiting to?'''
+    return is_running(_name(did)) or os.path.exists(_queued(wf, did))
+
+
+def refresh_cards(wf, did):
+    '''Refresh deck ``did``'s card cache in the background,
+       now or when a job slot frees up'''
+
+    _unlink(_prefetched(wf, did))
+    if is_running(_name(did)):
+        return
+    if len(running(wf)) >= MAX_JOBS:
+        open(_queued(wf, did), 'a').close()
+        wf.logger.debug('Deck {} queued for refresh'.format(did))
+        return
+    _start(wf, did)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def _rank(path):
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def _take(wf, paths):
+    '''Start the first deck in ``paths`` (marker files) no
+       other job took first, returns its id'''
+    for path in paths:
+        if not _unlink(path):
+            continue    # another job took it
+        did = _did(path)
+        if not is_running(_name(did)):
+            _start(wf, did)
+            return did
+
+
+def _start_prefetch(wf, busy):
+    # one slot stays free for the deck the user opens next
+    if busy < MAX_JOBS - 1:
+        return _take(wf, sorted(glob.glob(_prefetched(wf, '*')), key=_rank))
+
+
+def prefetch(wf, dids):
+    '''Warm the card caches of ``dids``, most wanted first,
+       replaces what the last call asked for'''
+
+    for path in glob.glob(_prefetched(wf, '*')):
+        _unlink(path)
+
+    for rank, did in enumerate(dids):
+        if not refreshing(wf, did):
+            with open(_prefetched(wf, did), 'w') as f:
+                f.write(str(rank))
+
+    return _start_prefetch(wf, len(running(wf)))
+
+
+def start_next(wf):
+    '''Called by a finishing job, hands its slot on to the
+       deck that has been queued longest, else to the next
+       prefetch'''
+
+    did = _take(wf, sorted(glob.glob(_queued(wf, '*')), key=_mtime))
+    if did is None:
+        # the finishing job still counts as running
+        did = _start_prefetch(wf, len(running(wf)) - 1)
+    return did
+
+
+def _thumbs_queued(wf, did):
+    return wf.cachefile('thumbs-{}.queued'.format(did))
+
+
+def refresh_thumbs(wf, did):
+    '''Make deck ``did``'s thumbnails in the background, now
+       or after the decks the running thumbs job has yet to do'''
+
+    open(_thumbs_queued(wf, did), 'a').close()
+    if not is_running('thumbs'):
+        cmd = ['/usr/bin/python', wf.workflowfile('background.py'), 'thumbs']
+        run_in_background('thumbs', cmd)
+
+
+def resume_thumbs(wf, did):
+    '''Start the thumbs job again if deck ``did`` was queued
+       as the last one was exiting'''
+
+    if os.path.exists(_thumbs_queued(wf, did)) and not is_running('thumbs'):
+        refresh_thumbs(wf, did)
+
+
+def next_thumbs(wf):
+    '''Called by the thumbs job, the deck that has been queued
+       longest, None when none is left'''
+
+    paths = sorted(glob.glob(_thumbs_queued(wf, '*')), key=_mtime)
+    for path in paths:
+        if _unlink(path):
+            return os.path.basename(path)[len('thumbs-'):].rsplit('.', 1)[0]
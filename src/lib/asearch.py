@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+########################################################
+# Full-collection search backed by a sidecar FTS5
+# database in the workflow cache dir. Only background.py
+# reads the collection to fill it; the script filter
+# queries the sidecar alone.
+
+import os, sqlite3
+
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS notes USING fts5(
+    flds, tags, did UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 1');
+CREATE TABLE IF NOT EXISTS decks (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+"""
+
+
+def supported():
+    '''True if this sqlite3 build has FTS5'''
+    db = sqlite3.connect(':memory:')
+    try:
+        db.execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        db.close()
+
+
+def match_expr(query):
+    '''Every query word as an FTS5 prefix term'''
+    words = [w.replace('"', '""') for w in query.split()]
+    return u' '.join(u'"{}"*'.format(w) for w in words if w)
+
+
+class SearchIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def update(self, at):
+        '''Add or replace notes changed since the last update,
+           drop notes that are gone. Returns notes written.'''
+        from anki import utils
+
+        db = sqlite3.connect(self.path)
+        try:
+            db.executescript(SCHEMA)
+            mark = db.execute("SELECT value FROM meta WHERE key = 'mod'").fetchone()
+            mark = mark[0] if mark else 0
+
+            # deck names change without touching notes, keep them whole
+            db.execute("DELETE FROM decks")
+            db.executemany("INSERT INTO decks VALUES (?, ?)",
+                           ((d['id'], d['name']) for d in at.all_decks()))
+
+            count = 0
+            for nid, mod, flds, tags, did in at.notes_since(mark):
+                flds = u' '.join(utils.stripHTMLMedia(f) for f in flds.split('\x1f') if f)
+                db.execute("DELETE FROM notes WHERE rowid = ?", (nid,))
+                db.execute("INSERT INTO notes (rowid, flds, tags, did) VALUES (?, ?, ?, ?)",
+                           (nid, flds, tags.strip(), did))
+                mark = max(mark, mod)
+                count += 1
+
+            live = set(at.note_ids())
+            gone = [(i,) for i, in db.execute("SELECT rowid FROM notes") if i not in live]
+            db.executemany("DELETE FROM notes WHERE rowid = ?", gone)
+
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('mod', ?)", (mark,))
+            db.commit()
+        finally:
+            db.close()
+
+        return count
+
+
+    def search(self, query, limit=50):
+        '''Best ``limit`` matches for ``query`` as dicts'''
+
+        expr = match_expr(query)
+        if not expr or not os.path.exists(self.path):
+            return []
+
+        db = sqlite3.connect(self.path)
+        try:
+            rows = db.execute("SELECT notes.rowid, notes.flds, notes.tags, decks.name "
+                              "FROM notes "
+                              "LEFT JOIN decks ON decks.id = notes.did "
+                              "WHERE notes MATCH ? "
+                              "ORDER BY rank LIMIT ?", (expr, limit)).fetchall()
+        except sqlite3.OperationalError:
+            return []
+        finally:
+            db.close()
+
+        return [{'nid': nid, 'flds': flds, 'tags': tags, 'deck': deck}
+                for nid, flds, tags, deck in rows]
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+########################################################
+# Thumbnails for card images.
+#
+# Thumbs are named by a hash of the image's content and
+# the thumb size, so media files with the same name don't
+# collide and an edited image gets a new thumb. ThumbStore
+# keeps an index of media path -> (mtime, size, thumb),
+# which skips images that haven't changed since their thumb
+# was made, and of thumb -> (bytes, last used). New thumbs
+# are made on a process pool, a few batches at a time.
+#
+# The store is kept under BUDGET bytes and LIMIT files by
+# dropping the least recently used thumbs, and collect()
+# deletes thumbs of media the collection no longer uses.
+
+import os, time, hashlib
+
+SIZE = (250, 250)
+INLINE = 4                      # fewer images than this aren't worth a pool
+BUDGET = 200 * 1024 * 1024      # bytes of thumbs kept
+LIMIT = 20000                   # thumbs kept
+COLLECT_EVERY = 24 * 60 * 60    # seconds between collect() runs
+STRAY_AGE = 60 * 60             # unindexed files younger than this may be in progress
+
+
+def _thumb(job):
+    '''Make the thumb for one image, runs in the pool.
+       Returns (src, thumb path or None if it can't be read)'''
+    src, thumbdir, size = job
+    from PIL import Image
+
+    try:
+        with open(src, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return src, None
+
+    ext = os.path.splitext(src)[1].lower()
+    thumb = os.path.join(thumbdir, '{}-{}x{}{}'.format(digest, size[0], size[1], ext))
+    if os.path.exists(thumb):
+        return src, thumb
+
+    # PIL picks the format from the extension, keep it last
+    tmp = os.path.join(thumbdir, '.{}-{}'.format(os.getpid(), os.path.basename(thumb)))
+    try:
+        im = Image.open(src)
+        im.thumbnail(size)
+        im.save(tmp)
+        os.rename(tmp, thumb)
+    except Exception:
+        # PIL raises more than IOError on truncated or corrupt
+        # images, one mustn't fail the whole pool
+        import logging
+        logging.getLogger('workflow').exception('No thumb for {!r}'.format(src))
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return src, None
+
+    return src, thumb
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def _bytes(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+
+class ThumbStore(object):
+    '''Thumbs in ``thumbdir``. ``state`` is what state() returned
+       last time, cache it between runs.'''
+
+    def __init__(self, thumbdir, state=None, budget=BUDGET, limit=LIMIT):
+        state = state or {}
+        self.thumbdir = thumbdir
+        self.sources = state.get('sources', {})
+        self.thumbs = state.get('thumbs', {})
+        self.collected = state.get('collected', 0)
+        self.budget = budget
+        self.limit = limit
+
+        if not os.path.exists(thumbdir):
+            os.makedirs(thumbdir)
+
+
+    def state(self):
+        return {'sources': self.sources, 'thumbs': self.thumbs, 'collected': self.collected}
+
+
+    def make(self, paths, size=SIZE, processes=None):
+        '''Thumbs for the images at ``paths`` as {path: thumb or None}'''
+
+        now = time.time()
+        thumbs, todo, stats = {}, [], {}
+        for path in set(paths):
+            stat = _stat(path)
+            known = self.sources.get(path)
+            if stat is None:
+                self.sources.pop(path, None)
+                thumbs[path] = None
+            elif known and known[:2] == stat and os.path.exists(known[2]):
+                thumbs[path] = known[2]
+                self._use(known[2], now)
+            else:
+                stats[path] = stat
+                todo.append((path, self.thumbdir, size))
+
+        if len(todo) < INLINE:
+            made = map(_thumb, todo)
+        else:
+            from multiprocessing import Pool, cpu_count
+            processes = processes or cpu_count()
+            pool = Pool(processes)
+            made = []
+            try:
+                # bounded, only a few batches are queued at a time
+                step = processes * 8
+                for i in xrange(0, len(todo), step):
+                    made.extend(pool.imap_unordered(_thumb, todo[i:i + step], 2))
+            finally:
+                pool.close()
+                pool.join()
+
+        for src, thumb in made:
+            thumbs[src] = thumb
+            if thumb:
+                self.sources[src] = stats[src] + (thumb,)
+                self._use(thumb, now)
+            else:
+                self.sources.pop(src, None)
+
+        return thumbs
+
+
+    def _use(self, thumb, now):
+        known = self.thumbs.get(thumb)
+        self.thumbs[thumb] = (known[0] if known else _bytes(thumb), now)
+
+
+    def _drop(self, thumbs):
+        thumbs = set(thumbs)
+        for thumb in thumbs:
+            self.thumbs.pop(thumb, None)
+            if os.path.exists(thumb):
+                os.unlink(thumb)
+
+        for src, entry in self.sources.items():
+            if entry[2] in thumbs:
+                del self.sources[src]
+
+
+    def evict(self):
+        '''Drop the least recently used thumbs over the budget
+           or the limit, returns how many were dropped'''
+
+        total = sum(b for b, _ in self.thumbs.itervalues())
+        count = len(self.thumbs)
+
+        gone = []
+        for thumb in sorted(self.thumbs, key=lambda t: self.thumbs[t][1]):
+            if total <= self.budget and count <= self.limit:
+                break
+            total -= self.thumbs[thumb][0]
+            count -= 1
+            gone.append(thumb)
+
+        self._drop(gone)
+        return len(gone)
+
+
+    def collect_due(self):
+        return time.time() - self.collected > COLLECT_EVERY
+
+
+    def collect(self, live):
+        '''Forget media not in ``live`` (the paths the collection
+           refers to), delete thumbs nothing uses and files in
+           thumbdir the index doesn't know. Returns files deleted.'''
+
+        for src in self.sources.keys():
+            if src not in live:
+                del self.sources[src]
+
+        used = set(entry[2] for entry in self.sources.itervalues())
+        gone = [t for t in self.thumbs if t not in used]
+        self._drop(gone)
+
+        now = time.time()
+        for name in os.listdir(self.thumbdir):
+            path = os.path.join(self.thumbdir, name)
+            if path in self.thumbs:
+                continue
+            try:
+                if now - os.path.getmtime(path) > STRAY_AGE:
+                    os.unlink(path)
+                    gone.append(path)
+            except OSError:
+                pass
+
+        self.collected = now
+        return len(gone)
@@ -5,6 +5,57 @@
 # Currently a hot mess...
 # This needs to be cleaned up...
 
+import os, time
+from contextlib import contextmanager
+
+
+def col_state(path):
+    '''Cheap fingerprint of the collection: col.mod plus the
+       WAL file's mtime and size (Anki only bumps col.mod on
+       save, the WAL changes with every write in between).
+       None if the collection can't be read.'''
+    import os, sqlite3
+
+    # connect() would create an empty collection in its place
+    if not os.path.exists(path):
+        return None
+
+    try:
+        st = os.stat(path + '-wal')
+        wal = (st.st_mtime, st.st_size)
+    except OSError:
+        wal = None
+
+    try:
+        db = sqlite3.connect(path)
+        try:
+            db.execute("PRAGMA query_only = ON")
+            mod = db.execute("SELECT mod FROM col").fetchone()[0]
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return None
+
+    return (mod, wal)
+
+
+def col_stat(path):
+    '''Stat-only fingerprint of the collection: mtime and size
+       of the collection file and of its WAL file. Never opens
+       the collection, for checks on the keystroke path.
+       None if the collection doesn't exist.'''
+    stats = []
+    for name in (path, path + '-wal'):
+        try:
+            st = os.stat(name)
+            stats.append((st.st_mtime, st.st_size))
+        except OSError:
+            stats.append(None)
+
+    if stats[0] is None:
+        return None
+    return tuple(stats)
+
 
 class AnkiFx(str):
     
@@ -106,13 +157,121 @@ class AnkiFx(str):
 #    self.col.close()
         
 
+class DeckTree(object):
+    '''Parent/child links of the decks, from their :: paths.
+       Built once from col.decks, subtrees are then walked
+       instead of matching names against every deck.'''
+
+    def __init__(self, decks):
+        self.names = dict((int(d['id']), d['name']) for d in decks)
+        ids = dict((name, did) for did, name in self.names.items())
+
+        self.parents = {}
+        self.kids = {}
+        for did, name in self.names.items():
+            parent = ids.get(name.rsplit('::', 1)[0]) if '::' in name else None
+            self.parents[did] = parent
+            if parent is not None:
+                self.kids.setdefault(parent, []).append(did)
+
+        self.ids = ids
+
+
+    def subtree(self, did):
+        '''did and the ids of all decks under it'''
+        did = int(did)
+        if did not in self.names:
+            return []
+        dids, todo = [], [did]
+        while todo:
+            did = todo.pop()
+            dids.append(did)
+            todo.extend(self.kids.get(did, ()))
+        return dids
+
+
+    def rollup(self, own):
+        '''Totals per deck of ``own`` ({did: {key: count}}) over
+           each deck's subtree, adding every deck to its parent
+           once, deepest decks first'''
+        totals = {}
+        for did in sorted(self.names, key=lambda d: -self.names[d].count('::')):
+            total = totals.setdefault(did, {})
+            for k, v in own.get(did, {}).items():
+                total[k] = total.get(k, 0) + v
+            parent = self.parents[did]
+            if parent is not None:
+                up = totals.setdefault(parent, {})
+                for k, v in total.items():
+                    up[k] = up.get(k, 0) + v
+        return totals
+
+
+
+class _Traced(object):
+    '''sqlite3 connection that adds its queries to anki.db's
+       stats. Callers read the rows lazily, anki.db's Cursor
+       counts them and times reading them as they do.'''
+
+    def __init__(self, db):
+        from anki import db as adb
+        object.__setattr__(self, '_db', db)
+        object.__setattr__(self, '_stats', adb.stats)
+        object.__setattr__(self, '_cursor', adb.Cursor)
+
+    def execute(self, sql, args=()):
+        t = time.time()
+        res = self._db.execute(sql, args)
+        return self._cursor(res, self._stats, sql, time.time() - t, args)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._db, name, value)
+
+
+
 class Tools(str):
     
     import sqlite3, json
+
+    TIMEOUT = 10.0      # seconds to wait out Anki's write lock
+    STATEMENTS = 200    # prepared statements kept per connection
     
-    def __init__(self, col):
+    def __new__(cls, col, readonly=True):
+        return str.__new__(cls, col)
+
+    def __init__(self, col, readonly=True):
+        '''Reads never write to the collection unless opened
+           with readonly=False (py2's sqlite3 has no URI
+           mode=ro, query_only refuses writes instead)'''
         self.col = col
-        self.db  = self.sqlite3.connect(self.col)
+        self.db  = self.sqlite3.connect(self.col, timeout=self.TIMEOUT,
+                                        cached_statements=self.STATEMENTS)
+        if readonly:
+            self.db.execute("PRAGMA query_only = ON")
+
+        # DBSTATS=path: time queries with anki.db's stats
+        if os.environ.get('DBSTATS'):
+            self.db = _Traced(self.db)
+
+
+    @contextmanager
+    def snapshot(self):
+        '''One read transaction: every query in the block sees
+           the collection as of the first one, whatever Anki
+           writes meanwhile. Those writes show up next refresh.'''
+
+        # autocommit, so sqlite3 doesn't end the transaction itself
+        level = self.db.isolation_level
+        self.db.isolation_level = None
+        self.db.execute("BEGIN")
+        try:
+            yield self
+        finally:
+            self.db.execute("COMMIT")
+            self.db.isolation_level = level
 
 
     def all_decks(self):
@@ -184,19 +343,9 @@ class Tools(str):
         # name tags did usn req flds sortf
         # tmpls mod latexPost latexPre
         # type id css
-        for _ in range(2):
-            try:
-                models = self.db.execute("SELECT models FROM col")
-                models = self.json.loads(models.fetchone()[0])
-                break
-            except OperationalError:
-                self.db.execute("PRAGMA busy_timeout = 30000")
-                pass
-        else:
-            raise Exception('database is busy')
-
-        #models = self.db.execute("SELECT models FROM col")    
-        #models = self.json.loads(models.fetchone()[0])
+        # busy waits are the connection's timeout
+        models = self.db.execute("SELECT models FROM col")
+        models = self.json.loads(models.fetchone()[0])
     
 
         for id, model in models.items():
@@ -204,6 +353,21 @@ class Tools(str):
                 return model
 
 
+    def model_fields(self):
+        '''Parses col.models once, returns
+           mid -> {'name': model name, 'flds': field names}'''
+
+        models = self.db.execute("SELECT models FROM col")
+        models = self.json.loads(models.fetchone()[0])
+
+        results = {}
+        for id, model in models.items():
+            results[id] = {'name': model['name'],
+                           'flds': [f['name'] for f in model['flds']]}
+
+        return results
+
+
 
 
     def card_info(self, **kwargs):
@@ -409,14 +573,19 @@ class Tools(str):
         
 
     
+    def deck_tree(self):
+        '''DeckTree of the collection, built on first use'''
+        if getattr(self, '_tree', None) is None:
+            self._tree = DeckTree(self.all_decks())
+        return self._tree
+
+
     def cnt_cards(self, did, name):
         cnt = self.card_info(did=did, count=True)
         if cnt > 0:
             return cnt
         else:
             matches = self._match_(name)
-            #afx = AnkiFx(self.col)
-            #matches = afx.children(did)
             return self.sum_cards(matches)
             
 
@@ -444,18 +613,22 @@ class Tools(str):
     
     
     def multi_stat(self, decks):
-        from collections import Counter
-        results = []
+        from anki import utils
 
-        for d in decks:
-            stats = self._stat(d['id'], multi=True)
-            results.append(stats)
+        # one grouped pass over all the decks' cards
+        stats = {'new': 0, 'learning': 0, 'review': 0}
+        rows = self.db.execute("SELECT queue, COUNT() FROM cards WHERE did IN " +
+                               utils.ids2str(d['id'] for d in decks) +
+                               " GROUP BY queue")
+        for queue, cnt in rows:
+            if queue == 2:
+                stats['review'] += cnt
+            elif queue == 0:
+                stats['new'] += cnt
+            elif queue in (1, 3):
+                stats['learning'] += cnt
         
-        combine = Counter()
-        for dic in results:
-            combine.update(dic)
-        
-        return dict(combine)
+        return stats
         
         
         
@@ -470,139 +643,184 @@ class Tools(str):
         return stats
 
 
+    def deck_summary(self):
+        '''Card, new, learning and review counts for every deck.
+           One grouped pass over cards, then the deck tree rolls
+           each deck's own counts up into its parents.'''
+
+        # queue: 0=new, 1=learning, 2=review, 3=day learn
+        # negative queues (suspended, buried) only count as cards
+
+        own = {}
+        rows = self.db.execute("SELECT did, queue, COUNT() "
+                               "FROM cards "
+                               "GROUP BY did, queue")
+
+        for did, queue, cnt in rows:
+            c = own.setdefault(did, {'cards': 0, 'new': 0, 'learning': 0, 'review': 0})
+            c['cards'] += cnt
+            if queue == 0:
+                c['new'] += cnt
+            elif queue == 2:
+                c['review'] += cnt
+            elif queue in (1, 3):
+                c['learning'] += cnt
+
+        totals = self.deck_tree().rollup(own)
+
+        results = []
+        for d in self.all_decks():
+            deck = {'id': d['id'], 'name': d['name'], 'mod': d['mod'],
+                    'cards': 0, 'new': 0, 'learning': 0, 'review': 0}
+            deck.update(totals.get(int(d['id']), {}))
+            results.append(deck)
+
+        return results
+
+
+
 
-   
     def base_name(self, name):
         return name.rsplit('::', 1)[0]
         #return name.split('::')[0]
 
 
     def _match_(self, base):
-        '''match deck name against all names
-        return all children if base name'''
+        '''deck `base` and all its children, by the
+        :: paths, not every name containing base'''
 
-        # name, extendRev, collapsed, browserCollapsed,
-        # newToday, timeToday, extendNew, conf, revToday
-        # lrnToday, id, mod
-        
-        results = []
-        all_decks = self.all_decks()
-        
-        for d in all_decks:
-            did  = d['id']        
-            name = d['name']
-
-            if base in name:
-                results.append({'id': did, 'name': name})
-
-        return results
-        
-        '''
-        results = []
-        key = [dk] #['name']
-    
-        for d in all_decks:
-            d1 = {k: d[k] for k in (key)}
-            d2 = {k:v for k, v in d1.items() if dv in str(v)}
-        
-            if len(d2.keys()):
-                results.append(d2)
+        tree = self.deck_tree()
+        did = tree.ids.get(base)
+        if did is None:
+            return []
 
-        return results
-        '''
+        return [{'id': d, 'name': tree.names[d]} for d in tree.subtree(did)]
 
 
     def sum_cards(self, matches):
+        from anki import utils
+
+        if not matches:
+            return 0
+        return self.db.execute("SELECT COUNT() FROM cards WHERE did IN " +
+                               utils.ids2str(m['id'] for m in matches)).fetchone()[0]
         
-        cnt = []
-        for match in matches:
-            cnt.append(self.card_info(did=match['id'], count=True))
-        
-        return sum(cnt)
-        
-        '''
-        for match in matches:
-            name, did = match
-            cnt.append(self.card_info(did=did, count=True))
-        
-        return sum(cnt)
-        '''
         
     def cids(self, did, utils):
-    
-        dids = [did]
-        DECK = self.deck_info(did=did)
-        NAME = DECK['name']
-        kids = self._match_(NAME)
-        kid_list = ()
-        for k in kids:
-            deck, name = k.values()
-            kid_list = kid_list + ((deck, name),)
-        
-        for id, name in kid_list:
-            dids.append(id)
-        
+        dids = self.deck_tree().subtree(did)
         _list = list(self.dids2cids(utils.ids2str(dids)))
         return [i for sub in _list for i in sub]
         
         
         
-    def deck_notes(self, did):
+    def deck_dids(self, did):
+        '''did plus the ids of the decks under it'''
+        return self.deck_tree().subtree(did) or [did]
+
+
+    def deck_nids(self, did):
+        '''Set of note ids with a card in the deck or its children'''
+        from anki import utils
+
+        rows = self.db.execute("SELECT DISTINCT nid FROM cards "
+                               "WHERE did IN " + utils.ids2str(self.deck_dids(did)))
+        return set(r[0] for r in rows)
+
+
+    def deck_marks(self, did):
+        '''Highest notes.mod and cards.mod in the deck and its children,
+           and the ids of those decks: moving a deck under this one
+           changes neither mod'''
+        from anki import utils
+
+        dids = self.deck_dids(did)
+        row = self.db.execute("SELECT MAX(notes.mod), MAX(cards.mod) "
+                              "FROM cards "
+                              "JOIN notes ON notes.id = cards.nid "
+                              "WHERE cards.did IN " + utils.ids2str(dids)).fetchone()
+        return {'notes': row[0] or 0, 'cards': row[1] or 0, 'dids': sorted(dids)}
+
+
+    def deck_notes(self, did, since=None):
+        '''Yields one dict per note in the deck and its children.
+           Notes and cards are read in a single JOIN, models are
+           parsed once for the whole deck. With since (see
+           deck_marks) only notes changed from then on.'''
         import re, os
         from anki import utils
-        
-        #afx = AnkiFx(self.col)
-        #cids = afx.did2cids(did=did)
-        cids = self.cids(did, utils)
-        
+
+        dids = self.deck_dids(did)
+
         components = self.col.split(os.sep)
         mediadir = ('/'.join(components[:-1]) + '/collection.media')
-        
-        nids = []
-        for cid in cids:
-            card = self.card_spec('nid', cid=cid)
-            nids.append(card[0])
-        
-        notes = []
-        for nid in nids:
-    
-            ndict = {'nid': None, 'flds': None, 'tags': None, 'mid': None, 'mname': None, 'img': None}
 
-            # note info for each note id
-            note = self.note_info(nid=nid)
+        models = self.model_fields()
+        src = re.compile('src="([^"]+)"', re.DOTALL)
 
-            # readable note fields, strip HTML
-            flds = filter(None, note['flds'].split('\x1f'))
-            m = lambda i: [re.findall('src="([^"]+)"', f, re.DOTALL) for f in i]
-            img = [x[0] for x in m(flds) if x]
-            f = lambda x: [utils.stripHTMLMedia(i) for i in x]
-            flds = f(flds)
-            
-            #f = lambda x: [utils.stripHTMLMedia(i) for i in x]
-            #flds = f(filter(None, note['flds'].split('\x1f')))
+        sql = ("SELECT DISTINCT notes.id, notes.flds, notes.tags, notes.mid "
+               "FROM notes "
+               "JOIN cards ON cards.nid = notes.id "
+               "WHERE cards.did IN " + utils.ids2str(dids))
 
-            # from note model id, retrieve model fields
-            mid = str(note['mid'])
+        if since:
+            rows = self.db.execute(sql + " AND (notes.mod >= ? OR cards.mod >= ?)",
+                                   (since['notes'], since['cards']))
+        else:
+            rows = self.db.execute(sql)
 
-            #model = afx.did2cids(mid=mid)    
-            model = self.model_info(mid=mid)
+        for nid, flds, tags, mid in rows:
+
+            ndict = {'nid': None, 'flds': None, 'tags': None, 'mid': None, 'mname': None, 'img': None}
+
+            # readable note fields, strip HTML
+            flds = filter(None, flds.split('\x1f'))
+            img = [x[0] for x in (src.findall(f) for f in flds) if x]
+            flds = [utils.stripHTMLMedia(f) for f in flds]
+
+            mid = str(mid)
 
-            # get field names for model
-            mflds = [mfld['name'] for mfld in model['flds']]
-    
             ndict['nid']   = nid
-            #ndict['flds']  = (' '.join(flds)).encode('utf-8')
             ndict['flds']  = flds
-            ndict['tags']  = note['tags']
+            ndict['tags']  = tags
             ndict['mid']   = mid
-            ndict['mname'] = model['name']
+            ndict['mname'] = models[mid]['name']
             if img:
                 ndict['img']   = '{}/{}'.format(mediadir, img[0])
-    
-            notes.append(ndict)
 
-        return notes
-        
+            yield ndict
+
+
+    def media_refs(self):
+        '''Paths of the media files referenced by src="" in any
+           note, built like deck_notes' img paths'''
+        import re, os
+
+        components = self.col.split(os.sep)
+        mediadir = ('/'.join(components[:-1]) + '/collection.media')
+        src = re.compile('src="([^"]+)"', re.DOTALL)
+
+        refs = set()
+        for flds, in self.db.execute("SELECT flds FROM notes WHERE flds LIKE '%src=%'"):
+            refs.update('{}/{}'.format(mediadir, f) for f in src.findall(flds))
+        return refs
+
+
+    def notes_since(self, mod):
+        '''(nid, mod, flds, tags, did) for notes whose note or
+           cards changed at or after mod, did of the first card'''
+
+        return self.db.execute("SELECT notes.id, MAX(notes.mod, IFNULL(c.mod, 0)), notes.flds, notes.tags, "
+                               "(SELECT did FROM cards WHERE nid = notes.id LIMIT 1) "
+                               "FROM notes "
+                               "LEFT JOIN (SELECT nid, MAX(mod) AS mod FROM cards GROUP BY nid) c "
+                               "ON c.nid = notes.id "
+                               "WHERE notes.mod >= ? OR c.mod >= ?", (mod, mod))
+
+
+    def note_ids(self):
+        return [r[0] for r in self.db.execute("SELECT id FROM notes")]
+
+
     def create_tags(self, nid, tags):
         import time
 
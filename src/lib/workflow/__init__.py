@@ -23,7 +23,7 @@ __copyright__ = 'Copyright 2014 Dean Jackson'
 
 
 # Workflow objects
-from .workflow import Workflow, manager
+from .workflow import Workflow, MatchKey, manager
 
 # Exceptions
 from .workflow import PasswordNotFound, KeychainError
@@ -70,6 +70,7 @@ from .workflow import (
 
 __all__ = [
     'Workflow',
+    'MatchKey',
     'manager',
     'PasswordNotFound',
     'KeychainError',
@@ -30,7 +30,6 @@ import re
 import subprocess
 
 import workflow
-import web
 
 # __all__ = []
 
@@ -187,6 +186,8 @@ def download_workflow(url):
         'Downloading updated workflow from `{0}` to `{1}` ...'.format(
             url, local_path))
 
+    # `web` is only needed for downloads, don't load it on import
+    import web
     response = web.get(url)
 
     with open(local_path, 'wb') as output:
@@ -233,6 +234,7 @@ def get_valid_releases(github_slug):
     def retrieve_releases():
         wf().logger.info(
             'Retrieving releases for `{0}` ...'.format(github_slug))
+        import web
         return web.get(api_url).json()
 
     slug = github_slug.replace('/', '-')
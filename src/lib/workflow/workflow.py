@@ -18,6 +18,8 @@ up your Python script to best utilise the :class:`Workflow` object.
 from __future__ import print_function, unicode_literals
 
 import binascii
+import heapq
+from itertools import islice
 import os
 import sys
 import string
@@ -695,6 +697,95 @@ manager.register('pickle', PickleSerializer)
 manager.register('json', JSONSerializer)
 
 
+class MatchKey(object):
+    """Search key with the parts :meth:`Workflow.filter` matches
+    against worked out once, instead of for every item, query word
+    and keystroke.
+
+    Return these from the ``key`` function passed to
+    :meth:`Workflow.filter`. Make them with
+    :meth:`Workflow.prepare_key`; to store them with cached data, keep
+    :meth:`pack` and rebuild the key with :meth:`unpack`.
+
+    Parts that weren't given are worked out the first time they are
+    needed.
+
+    :param value: the search key
+    :type value: ``unicode``
+    :param folded: ``value`` folded to ASCII, if that differs
+    :param capitals: lower-cased capitals of ``folded``
+    :param atoms: lower-cased "atoms" of ``folded``
+    :type atoms: ``list``
+    :param initials: first letters of ``atoms``
+
+    """
+
+    __slots__ = ('value', 'folded', 'lower', '_chars', '_capitals',
+                 '_atoms', '_initials')
+
+    def __init__(self, value, folded=None, capitals=None, atoms=None,
+                 initials=None):
+        self.value = value
+        self.folded = value if folded is None else folded
+        self.lower = self.folded.lower()
+        self._chars = None
+        self._capitals = capitals
+        self._atoms = atoms
+        self._initials = initials
+
+    @property
+    def chars(self):
+        if self._chars is None:
+            self._chars = set(self.lower)
+        return self._chars
+
+    @property
+    def capitals(self):
+        if self._capitals is None:
+            self._capitals = ''.join([c for c in self.folded
+                                      if c in INITIALS]).lower()
+        return self._capitals
+
+    @property
+    def atoms(self):
+        if self._atoms is None:
+            self._atoms = [s.lower() for s in
+                           split_on_delimiters(self.folded)]
+        return self._atoms
+
+    @property
+    def initials(self):
+        if self._initials is None:
+            self._initials = ''.join([s[0] for s in self.atoms if s])
+        return self._initials
+
+    def pack(self):
+        """Return the prepared parts (not ``value``) as one string
+
+        :rtype: ``unicode``
+
+        """
+
+        folded = '' if self.folded == self.value else self.folded
+        return '\x1f'.join((folded, self.capitals, ' '.join(self.atoms),
+                             self.initials))
+
+    @classmethod
+    def unpack(cls, value, packed):
+        """Rebuild the :class:`MatchKey` for ``value`` from the string
+        :meth:`pack` returned
+
+        """
+
+        # :meth:`Workflow.prepare_key` packed the stripped value, an
+        # empty `folded` means the stripped value, not ``value``
+        value = value.strip()
+        # only `folded` could contain the separator
+        folded, capitals, atoms, initials = packed.rsplit('\x1f', 3)
+        return cls(value, folded or None, capitals, atoms.split(' '),
+                   initials)
+
+
 class Item(object):
     """Represents a feedback item for Alfred. Generates Alfred-compliant
     XML for a single item.
@@ -787,6 +878,13 @@ class Item(object):
         return root
 
 
+class _LazyItems(object):
+    """Items added with :meth:`Workflow.add_items`, not made yet"""
+
+    def __init__(self, items):
+        self.items = items
+
+
 class Settings(dict):
     """A dictionary that saves itself when changed.
 
@@ -901,6 +999,9 @@ class Workflow(object):
     # won't want to change this
     item_class = Item
 
+    # Most items :meth:`send_feedback` writes, ``0`` for all of them
+    max_items = 0
+
     def __init__(self, default_settings=None, update_settings=None,
                  input_encoding='utf-8', normalization='NFC',
                  capture_args=True, libraries=None,
@@ -1583,7 +1684,8 @@ class Workflow(object):
 
         self.logger.debug('Stored data saved at : {0}'.format(data_path))
 
-    def cached_data(self, name, data_func=None, max_age=60):
+    def cached_data(self, name, data_func=None, max_age=60,
+                    serializer=None):
         """Retrieve data from cache or re-generate and re-cache data if
         stale/non-existant. If ``max_age`` is 0, return cached data no
         matter how old.
@@ -1593,15 +1695,18 @@ class Workflow(object):
         :type data_func: ``callable``
         :param max_age: maximum age of cached data in seconds
         :type max_age: ``int``
+        :param serializer: name of a registered serializer to use instead
+            of :attr:`cache_serializer` for this datastore
         :returns: cached data, return value of ``data_func`` or ``None``
             if ``data_func`` is not set
 
         """
 
-        serializer = manager.serializer(self.cache_serializer)
+        serializer_name = serializer or self.cache_serializer
+        serializer = manager.serializer(serializer_name)
 
-        cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
-        age = self.cached_data_age(name)
+        cache_path = self.cachefile('%s.%s' % (name, serializer_name))
+        age = self.cached_data_age(name, serializer_name)
 
         if (age < max_age or max_age == 0) and os.path.exists(cache_path):
 
@@ -1614,25 +1719,73 @@ class Workflow(object):
             return None
 
         data = data_func()
-        self.cache_data(name, data)
+        self.cache_data(name, data, serializer_name)
 
         return data
 
-    def cache_data(self, name, data):
+    def cached_view(self, name, serializer=None):
+        """Return a lazy, read-only view of the data cached at ``name``,
+        or ``None`` if there is no cache.
+
+        The cache file is memory-mapped and handed to the serializer's
+        ``view()`` method, so records are only decoded when they are
+        read. Only serializers that have a ``view()`` method (e.g. the
+        ``columns`` serializer in ``acache``) support this; for others
+        a :class:`ValueError` is raised.
+
+        :meth:`cache_data` replaces cache files rather than rewriting
+        them, so the view stays valid if the cache is updated.
+
+        :param name: name of datastore
+        :param serializer: name of a registered serializer to use instead
+            of :attr:`cache_serializer` for this datastore
+        :returns: object returned by the serializer's ``view()`` or
+            ``None``
+
+        """
+
+        import mmap
+
+        serializer_name = serializer or self.cache_serializer
+        serializer = manager.serializer(serializer_name)
+
+        if not hasattr(serializer, 'view'):
+            raise ValueError('Serializer `{0}` has no view()'.format(
+                             serializer_name))
+
+        cache_path = self.cachefile('%s.%s' % (name, serializer_name))
+
+        if not os.path.exists(cache_path) or not os.path.getsize(cache_path):
+            return None
+
+        with open(cache_path, 'rb') as file_obj:
+            self.logger.debug('Mapping cached data from : %s', cache_path)
+            buf = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return serializer.view(buf)
+
+    def cache_data(self, name, data, serializer=None):
         """Save ``data`` to cache under ``name``.
 
         If ``data`` is ``None``, the corresponding cache file will be
         deleted.
 
+        The data is written to a temporary file that then replaces the
+        cache file, so readers (or memory maps of the old file) never
+        see a partly-written cache.
+
         :param name: name of datastore
         :param data: data to store. This may be any object supported by
                 the cache serializer
+        :param serializer: name of a registered serializer to use instead
+            of :attr:`cache_serializer` for this datastore
 
         """
 
-        serializer = manager.serializer(self.cache_serializer)
+        serializer_name = serializer or self.cache_serializer
+        serializer = manager.serializer(serializer_name)
 
-        cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
+        cache_path = self.cachefile('%s.%s' % (name, serializer_name))
 
         if data is None:
             if os.path.exists(cache_path):
@@ -1640,41 +1793,46 @@ class Workflow(object):
                 self.logger.debug('Deleted cache file : %s', cache_path)
             return
 
-        with open(cache_path, 'wb') as file_obj:
+        temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(temp_path, 'wb') as file_obj:
             serializer.dump(data, file_obj)
+        os.rename(temp_path, cache_path)
 
         self.logger.debug('Cached data saved at : %s', cache_path)
 
-    def cached_data_fresh(self, name, max_age):
+    def cached_data_fresh(self, name, max_age, serializer=None):
         """Is data cached at `name` less than `max_age` old?
 
         :param name: name of datastore
         :param max_age: maximum age of data in seconds
         :type max_age: ``int``
+        :param serializer: name of the serializer the data was cached with
         :returns: ``True`` if data is less than ``max_age`` old, else
             ``False``
 
         """
 
-        age = self.cached_data_age(name)
+        age = self.cached_data_age(name, serializer)
 
         if not age:
             return False
 
         return age < max_age
 
-    def cached_data_age(self, name):
+    def cached_data_age(self, name, serializer=None):
         """Return age of data cached at `name` in seconds or 0 if
         cache doesn't exist
 
         :param name: name of datastore
         :type name: ``unicode``
+        :param serializer: name of the serializer the data was cached with
         :returns: age of datastore in seconds
         :rtype: ``int``
 
         """
 
-        cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
+        serializer_name = serializer or self.cache_serializer
+        cache_path = self.cachefile('%s.%s' % (name, serializer_name))
 
         if not os.path.exists(cache_path):
             return 0
@@ -1683,7 +1841,7 @@ class Workflow(object):
 
     def filter(self, query, items, key=lambda x: x, ascending=False,
                include_score=False, min_score=0, max_results=0,
-               match_on=MATCH_ALL, fold_diacritics=True):
+               match_on=MATCH_ALL, fold_diacritics=True, matched=None):
         """Fuzzy search filter. Returns list of ``items`` that match ``query``.
 
         ``query`` is case-insensitive. Any item that does not contain the
@@ -1712,6 +1870,8 @@ class Workflow(object):
             than this.
         :type min_score: ``int``
         :param max_results: If non-zero, prune results list to this length.
+            Only the best ``max_results`` matches are kept while
+            filtering, so large ``items`` aren't sorted in full.
         :type max_results: ``int``
         :param match_on: Filter option flags. Bitwise-combined list of
             ``MATCH_*`` constants (see below).
@@ -1719,6 +1879,11 @@ class Workflow(object):
         :param fold_diacritics: Convert search keys to ASCII-only
             characters if ``query`` only contains ASCII characters.
         :type fold_diacritics: ``Boolean``
+        :param matched: If given, every item that matches ``query`` is
+            appended to this list (in ``items`` order), including those
+            cut by ``max_results``. With :const:`MATCH_SUBSTRING` on, the
+            matches for a query that extends ``query`` are among these.
+        :type matched: ``list``
         :returns: list of ``items`` matching ``query`` or list of
             ``(item, score, rule)`` `tuples` if ``include_score`` is ``True``.
             ``rule`` is the ``MATCH_*`` rule that matched the item.
@@ -1794,45 +1959,59 @@ class Workflow(object):
         fold_diacritics = self.settings.get('__workflow_diacritic_folding',
                                             fold_diacritics)
 
-        results = []
-
-        for item in items:
-            skip = False
-            score = 0
-            words = [s.strip() for s in query.split(' ')]
-            value = key(item).strip()
-            if value == '':
-                continue
-            for word in words:
-                if word == '':
+        words = [s.strip() for s in query.split(' ')]
+        words = [w for w in words if w]
+        fold = fold_diacritics and any(isascii(w) for w in words)
+
+        def matches():
+            for item in items:
+                value = key(item)
+                prepared = None
+                if isinstance(value, MatchKey):
+                    prepared = value
+                    value = prepared.value
+                value = value.strip()
+                if value == '':
                     continue
-                s, rule = self._filter_item(value, word, match_on,
-                                            fold_diacritics)
-
-                if not s:  # Skip items that don't match part of the query
-                    skip = True
-                score += s
-
-            if skip:
-                continue
 
-            if score:
-                # use "reversed" `score` (i.e. highest becomes lowest) and
-                # `value` as sort key. This means items with the same score
-                # will be sorted in alphabetical not reverse alphabetical order
-                results.append(((100.0 / score, value.lower(), score),
-                                (item, score, rule)))
+                # fold once per item, not once per word
+                if prepared is None:
+                    folded = self.fold_to_ascii(value) if fold else value
+
+                score = 0
+                for word in words:
+                    if prepared is not None and fold and isascii(word):
+                        s, rule = self._filter_key(prepared, word.lower(),
+                                                   match_on)
+                    else:
+                        s, rule = self._filter_item(
+                            folded if fold and isascii(word) else value,
+                            word, match_on, False)
+
+                    if not s:  # Skip items that don't match part of the query
+                        break
+                    score += s
 
-        # sort on keys, then discard the keys
-        results.sort(reverse=ascending)
+                else:
+                    if score and (not min_score or score > min_score):
+                        if matched is not None:
+                            matched.append(item)
+                        # use "reversed" `score` (i.e. highest becomes
+                        # lowest) and `value` as sort key. This means items
+                        # with the same score will be sorted in alphabetical
+                        # not reverse alphabetical order
+                        yield ((100.0 / score, value.lower(), score),
+                               (item, score, rule))
+
+        # sort on keys, then discard the keys. With `max_results`, keep
+        # a heap of the best results instead of sorting all of them
+        if max_results:
+            best = heapq.nlargest if ascending else heapq.nsmallest
+            results = best(max_results, matches())
+        else:
+            results = sorted(matches(), reverse=ascending)
         results = [t[1] for t in results]
 
-        if min_score:
-            results = [r for r in results if r[1] > min_score]
-
-        if max_results and len(results) > max_results:
-            results = results[:max_results]
-
         # return list of ``(item, score, rule)``
         if include_score:
             return results
@@ -1860,17 +2039,40 @@ class Workflow(object):
 
             return (0, None)
 
+        return self._score_key(MatchKey(value), query, match_on)
+
+    def _filter_key(self, key, query, match_on):
+        """Filter :class:`MatchKey` ``key`` against lower-case ``query``
+        using rules ``match_on``
+
+        :returns: ``(score, rule)``
+
+        """
+
+        if not set(query) <= key.chars:
+
+            return (0, None)
+
+        return self._score_key(key, query, match_on)
+
+    def _score_key(self, key, query, match_on):
+        """Score ``key`` that has all the characters of ``query``
+
+        :returns: ``(score, rule)``
+
+        """
+
         # item starts with query
-        if match_on & MATCH_STARTSWITH and value.lower().startswith(query):
-            score = 100.0 - (len(value) / len(query))
+        if match_on & MATCH_STARTSWITH and key.lower.startswith(query):
+            score = 100.0 - (len(key.lower) / len(query))
 
             return (score, MATCH_STARTSWITH)
 
         # query matches capitalised letters in item,
         # e.g. of = OmniFocus
         if match_on & MATCH_CAPITALS:
-            initials = ''.join([c for c in value if c in INITIALS])
-            if initials.lower().startswith(query):
+            initials = key.capitals
+            if initials.startswith(query):
                 score = 100.0 - (len(initials) / len(query))
 
                 return (score, MATCH_CAPITALS)
@@ -1880,17 +2082,16 @@ class Workflow(object):
         if (match_on & MATCH_ATOM or
                 match_on & MATCH_INITIALS_CONTAIN or
                 match_on & MATCH_INITIALS_STARTSWITH):
-            atoms = [s.lower() for s in split_on_delimiters(value)]
-            # print('atoms : %s  -->  %s' % (value, atoms))
+            atoms = key.atoms
             # initials of the atoms
-            initials = ''.join([s[0] for s in atoms if s])
+            initials = key.initials
 
         if match_on & MATCH_ATOM:
             # is `query` one of the atoms in item?
             # similar to substring, but scores more highly, as it's
             # a word within the item
             if query in atoms:
-                score = 100.0 - (len(value) / len(query))
+                score = 100.0 - (len(key.lower) / len(query))
 
                 return (score, MATCH_ATOM)
 
@@ -1913,8 +2114,8 @@ class Workflow(object):
             return (score, MATCH_INITIALS_CONTAIN)
 
         # `query` is a substring of item
-        if match_on & MATCH_SUBSTRING and query in value.lower():
-            score = 90.0 - (len(value) / len(query))
+        if match_on & MATCH_SUBSTRING and query in key.lower:
+            score = 90.0 - (len(key.lower) / len(query))
 
             return (score, MATCH_SUBSTRING)
 
@@ -1922,7 +2123,7 @@ class Workflow(object):
         # characters in `query` are in item.
         if match_on & MATCH_ALLCHARS:
             search = self._search_for_query(query)
-            match = search(value)
+            match = search(key.folded)
             if match:
                 score = 100.0 / ((1 + match.start()) *
                                  (match.end() - match.start() + 1))
@@ -2078,13 +2279,46 @@ class Workflow(object):
         self._items.append(item)
         return item
 
-    def send_feedback(self):
-        """Print stored items to console/Alfred as XML."""
-        root = ET.Element('items')
+    def add_items(self, items):
+        """Add items to be output to Alfred, lazily
+
+        :param items: ``dict`` of :meth:`add_item` keyword arguments per
+            item, in any iterable
+        :type items: ``iterable``
+
+        ``items`` is read by :meth:`send_feedback`, one item at a time and
+        only as far as :attr:`max_items` allows, so it can be a generator
+        over far more results than Alfred will show.
+
+        """
+
+        self._items.append(_LazyItems(items))
+
+    def _feedback_items(self):
+        """Yield the stored items, making lazy ones as they're reached"""
         for item in self._items:
-            root.append(item.elem)
-        sys.stdout.write('<?xml version="1.0" encoding="utf-8"?>\n')
-        sys.stdout.write(ET.tostring(root).encode('utf-8'))
+            if isinstance(item, _LazyItems):
+                for kwargs in item.items:
+                    yield self.item_class(**kwargs)
+            else:
+                yield item
+
+    def send_feedback(self):
+        """Print stored items to console/Alfred as XML.
+
+        Items are serialized one at a time, without building a tree of
+        all of them, and at most :attr:`max_items` are written if that's
+        set. The output is written in one go, so an item that fails to
+        build doesn't leave half a document before :meth:`run`'s error
+        item.
+
+        """
+
+        xml = ['<?xml version="1.0" encoding="utf-8"?>\n<items>']
+        for item in islice(self._feedback_items(), self.max_items or None):
+            xml.append(ET.tostring(item.elem).encode('utf-8'))
+        xml.append('</items>')
+        sys.stdout.write(''.join(xml))
         sys.stdout.flush()
 
     ####################################################################
@@ -2158,6 +2392,10 @@ class Workflow(object):
             from update import Version
             version = Version(version)
 
+        # Don't rewrite the settings file on every run
+        if self.settings.get('__workflow_last_version') == str(version):
+            return True
+
         self.settings['__workflow_last_version'] = str(version)
 
         self.logger.debug('Set last run version : {0}'.format(version))
@@ -2587,6 +2825,21 @@ class Workflow(object):
             text = unicode(text, encoding)
         return unicodedata.normalize(normalization, text)
 
+    def prepare_key(self, value):
+        """Return a :class:`MatchKey` for search key ``value`` with all
+        its parts worked out, for :meth:`filter` to reuse.
+
+        :param value: search key
+        :type value: ``unicode``
+        :rtype: :class:`MatchKey`
+
+        """
+
+        value = value.strip()
+        key = MatchKey(value, self.fold_to_ascii(value))
+        key.capitals, key.atoms, key.initials
+        return key
+
     def fold_to_ascii(self, text):
         """Convert non-ASCII characters to closest ASCII equivalent.
 
@@ -7,13 +7,15 @@ from lib.workflow.background import run_in_background
 from lib.atools import Tools, AnkiFx
 
 __usage__ = """
-proxy.py <action> [card | col | new | tags | apath] [<name>|<nid>]
+proxy.py <action> [card | col | new | tags | apath | on | off] [<name>|<nid>]
 
 Usage:
     proxy.py deck [new] [<name>]
     proxy.py update [col]
     proxy.py card [new | tags] [<nid>]
     proxy.py trigger [card | tags | apath]
+    proxy.py open <name>
+    proxy.py server [on | off]
 
 Arguments:
     <name>     Deck name
@@ -57,8 +59,8 @@ def main(wf):
         run_in_background('decks', cmd)
         
     def update_cards():
-        cmd = ['/usr/bin/python', wf.workflowfile('background.py'), 'cards']
-        run_in_background('cards', cmd)
+        from lib.arefresh import refresh_cards
+        refresh_cards(wf, wf.cached_data('did', None, max_age=0))
 
     
     # ------------------------------------------------------------------
@@ -141,6 +143,33 @@ def main(wf):
         
         
         
+    # ------------------------------------------------------------------
+    # ------------------------------------------------------------------
+    # Query server
+    # proxy.py server [on | off]
+    # called from anki.py do_set, server.py stops itself
+    # once the setting is off
+    
+    if args.get('server'):
+        wf.settings['server'] = bool(args.get('on'))
+        print('Query server {}'.format('on' if args.get('on') else 'off'))
+        return 0
+
+
+
+    # ------------------------------------------------------------------
+    # ------------------------------------------------------------------
+    # Open a search result in the :anki script filter
+    # proxy.py open <name>
+    # called from anki.py do_search
+
+    if args.get('open'):
+        query = u':anki {}{}'.format(wf.decode(DELIMITER), args['<name>'])
+        run_alfred(query.encode('utf-8'))
+        return 0
+
+
+
     # ------------------------------------------------------------------
     # ------------------------------------------------------------------ 
     # Deck functions
@@ -200,7 +229,7 @@ def main(wf):
         # user_tags cached in new_tags.py(66)
         
         if args.get('tags'):
-            at = Tools(apath)
+            at = Tools(apath, readonly=False)
             nid = args['<nid>']
             data = wf.cached_data('user_tags', max_age=0)
             
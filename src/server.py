@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+########################################################
+# Optional long-lived server for the script filters.
+#
+# anki.py hands its argv to this process over a Unix
+# socket and prints the XML it gets back, so keystrokes
+# skip interpreter start-up, imports, settings and cache
+# unpickling. Turned on/off from :aset, started by
+# anki.py and quits after IDLE seconds without queries.
+#
+# It does not keep a connection to collection.anki2
+# open: Anki switches the journal mode when it closes
+# the collection, which fails while another connection
+# is open.
+#
+# The socket lives in a 0700 directory of the user's own
+# under $TMPDIR, and anki.py only talks to a socket that
+# is theirs: whatever answers is printed as Alfred items.
+
+import os, sys, stat, json, socket
+
+IDLE = 600
+TIMEOUT = 2.0
+
+
+def socket_dir():
+    '''Short path, Unix socket paths are limited to ~100 bytes.
+       $TMPDIR is per user on OS X, /tmp is shared.'''
+    bundleid = os.environ.get('alfred_workflow_bundleid')
+    if not bundleid:
+        return None
+    base = os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(base, '{}-{}'.format(bundleid, os.getuid()))
+
+
+def socket_path():
+    path = socket_dir()
+    if not path:
+        return None
+    return os.path.join(path, 'server.sock')
+
+
+def _owned(path, kind, private=False):
+    '''Is ``path`` a ``kind`` (stat.S_ISDIR, S_ISSOCK) of this
+       user's, and with ``private`` closed to everyone else?'''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not kind(st.st_mode) or st.st_uid != os.getuid():
+        return False
+    return not (private and st.st_mode & 077)
+
+
+def forward(args):
+    '''Client side, called by anki.py before anything else is
+       imported. Writes the server's reply to stdout and returns
+       True, or False if there is no server to answer.'''
+
+    path = socket_path()
+    if not path or not os.path.exists(path):
+        return False
+
+    # someone else's socket would choose the items and args
+    if not (_owned(os.path.dirname(path), stat.S_ISDIR, private=True) and
+            _owned(path, stat.S_ISSOCK)):
+        return False
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(TIMEOUT)
+    try:
+        s.connect(path)
+        s.sendall(json.dumps(args) + '\n')
+        reply = []
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            reply.append(data)
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+    if not reply:
+        return False
+
+    sys.stdout.write(''.join(reply))
+    sys.stdout.flush()
+    return True
+
+
+def main(wf):
+    import imp, time, signal, SocketServer
+    from StringIO import StringIO
+    from lib.workflow import Workflow
+
+    class WarmWorkflow(Workflow):
+        '''Keeps loaded caches in memory until their file changes'''
+
+        _warm = {}
+
+        def cached_data(self, name, data_func=None, max_age=60, serializer=None):
+            path = self.cachefile('%s.%s' % (name, serializer or self.cache_serializer))
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+
+            if mtime and (max_age == 0 or time.time() - mtime < max_age):
+                warm = self._warm.get(path)
+                if warm and warm[0] == mtime:
+                    return warm[1]
+
+            data = super(WarmWorkflow, self).cached_data(name, data_func, max_age,
+                                                         serializer)
+            if mtime:
+                self._warm[path] = (os.stat(path).st_mtime, data)
+            return data
+
+    awf = WarmWorkflow()
+    anki = imp.load_source('anki_wf', wf.workflowfile('anki.py'))
+    anki.wf = awf
+    anki.log = awf.logger
+    anki.MATCHERS = {}
+    awf._update_settings = anki.UPDATE_SETTINGS
+
+
+    def answer(args):
+        '''Run anki.py's main for args, return its XML'''
+        sys.argv = ['anki.py'] + [a.encode('utf-8') for a in args]
+        awf._items = []
+        awf._settings = None
+        anki.startup = anki.Startup()
+        out = StringIO()
+        sys.stdout = out
+        try:
+            awf.run(anki.main)
+        except SystemExit:
+            pass
+        finally:
+            sys.stdout = sys.__stdout__
+        return out.getvalue()
+
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            self.server.last = time.time()
+            args = json.loads(self.rfile.readline())
+            self.wfile.write(answer(args))
+
+
+    path = socket_path()
+    if not path:
+        log.error('No bundle id in environment, not starting server')
+        return 1
+
+    dirname = os.path.dirname(path)
+    if not os.path.lexists(dirname):
+        os.mkdir(dirname, 0700)
+    if not _owned(dirname, stat.S_ISDIR, private=True):
+        log.error('{} is not a private directory, not starting server'.format(dirname))
+        return 1
+
+    if os.path.lexists(path):
+        os.unlink(path)
+
+    server = SocketServer.UnixStreamServer(path, Handler)
+    os.chmod(path, 0600)
+    server.timeout = 5
+    server.last = time.time()
+    log.debug('Server listening on {}'.format(path))
+
+    # clean up the socket when killed
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    try:
+        while time.time() - server.last < IDLE:
+            # re-read, :aset may have turned the server off meanwhile
+            awf._settings = None
+            if not awf.settings.get('server'):
+                break
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+        log.debug('Server stopped')
+
+
+
+if __name__ == '__main__':
+    from lib.workflow import Workflow
+    wf = Workflow(libraries=[os.path.join(os.path.dirname(__file__), 'lib')])
+    log = wf.logger
+    wf.run(main)